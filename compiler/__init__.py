@@ -0,0 +1 @@
+VERSION = "0.1a"
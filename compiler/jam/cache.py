@@ -0,0 +1,138 @@
+import os
+import pickle
+import hashlib
+import tempfile
+
+from .. import VERSION
+
+#
+# Parse Cache
+#
+# A content addressed cache of parsed, unverified lekvar modules. Entries are
+# keyed by a hash of the source and of the compiler's own sources, so that
+# changing either invalidates them. The layout of pickled objects depends on
+# the compiler code, so entries written by any other version are never loaded.
+# The total size of the cache is bounded by evicting the least recently used
+# entries.
+
+DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "jam")
+MAX_SIZE = 256 * 1024 * 1024
+
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_compiler_hash = None
+
+# Return a hash of the version and python sources of the compiler package
+def compilerHash() -> bytes:
+    global _compiler_hash
+
+    if _compiler_hash is None:
+        hash = hashlib.sha256()
+        hash.update(VERSION.encode("UTF-8"))
+
+        paths = []
+        for directory, directories, files in os.walk(PACKAGE):
+            directories.sort()
+            paths += [os.path.join(directory, name) for name in sorted(files) if name.endswith(".py")]
+
+        for path in paths:
+            hash.update(os.path.relpath(path, PACKAGE).encode("UTF-8"))
+            with open(path, "rb") as f:
+                hash.update(f.read())
+
+        _compiler_hash = hash.digest()
+    return _compiler_hash
+
+class Cache:
+    directory = None
+    max_size = None
+
+    def __init__(self, directory:str = DIRECTORY, max_size:int = MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    # Return the key of a source, given any options affecting the parse
+    def key(self, source:str, *options) -> str:
+        hash = hashlib.sha256()
+        hash.update(compilerHash())
+        hash.update(repr(options).encode("UTF-8"))
+        hash.update(source.encode("UTF-8"))
+        return hash.hexdigest()
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.directory, key + ".pickle")
+
+    # Return the cached object for a key, or None
+    def load(self, key:str):
+        path = self.path(key)
+
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            # Ignore broken entries
+            self.remove(path)
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return value
+
+    # Cache an object for a key. Objects that can't be stored are ignored
+    def save(self, key:str, value):
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, RecursionError, TypeError, AttributeError):
+            return
+
+        if len(data) > self.max_size:
+            return
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            # Write atomically, so concurrent compilations never read partial
+            # entries
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self.path(key))
+        except OSError:
+            self.remove(temp_path)
+            return
+
+        self.evict()
+
+    # Remove least recently used entries until the cache fits its size
+    def evict(self):
+        entries = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".pickle"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            self.remove(path)
+            size -= entry_size
+
+    def remove(self, path:str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
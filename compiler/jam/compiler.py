@@ -1,7 +1,9 @@
 import logging
+import pickle
 from io import IOBase
 
 from . import parser
+from .cache import Cache
 from .. import lekvar
 from ..llvm import emitter as llvm
 from ..llvm.builtins import builtins
@@ -11,29 +13,63 @@ llvm.builtins = builtins
 
 BUILTINS = "compiler/jam/builtins.jm"
 
-def builtins():
+def builtins(cache:Cache = None):
     with open(BUILTINS, "r") as f:
-        ir = parser.parseFile(f)
+        ir = parser.parseFile(f, cache=cache)
 
     # Inject backend builtins into frontend builtins (there may be a better method?)
     ir.context.addChild(llvm.builtins())
 
     return ir
 
-def _compile(input:IOBase, logger):
+#
+# Builtins Snapshot
+#
+# The builtins are parsed once, then kept as a pickled snapshot in memory and
+# in the cache. Every compilation unpickles its own copy, so state set during
+# verification and emission is never shared. Builtins are verified lazily, as
+# they are used.
+
+_snapshot = None
+
+# The key covers the backend builtins through the hash of the compiler sources
+def snapshotKey(cache:Cache) -> str:
+    with open(BUILTINS, "r") as f:
+        return cache.key(f.read(), "snapshot")
+
+# Return a fresh, unverified builtins module
+def loadBuiltins(cache:Cache = None):
+    global _snapshot
+
+    if _snapshot is None and cache is not None:
+        _snapshot = cache.load(snapshotKey(cache))
+
+    if _snapshot is None:
+        _snapshot = pickle.dumps(builtins(cache), pickle.HIGHEST_PROTOCOL)
+
+        if cache is not None:
+            cache.save(snapshotKey(cache), _snapshot)
+
+    return pickle.loads(_snapshot)
+
+def _compile(input:IOBase, logger, cache, library):
+    cache = Cache() if cache else None
+
     # Produce lekvar
-    ir = parser.parseFile(input)
-    lekvar.verify(ir, builtins(), logger=logger, source=input)
+    ir = parser.parseFile(input, cache=cache)
+    lekvar.verify(ir, loadBuiltins(cache), logger=logger, source=input, library=library)
     # Emit LLVM
     return llvm.emit(ir, logger)
 
-def compileRun(input:IOBase, output:IOBase = None, logger = logging.getLogger()):
-    source = _compile(input, logger)
+# If cache is set, parsed source files are cached on disk. If library is set,
+# definitions are compiled even if the main instructions never use them
+def compileRun(input:IOBase, output:IOBase = None, logger = logging.getLogger(), cache = False, library = False):
+    source = _compile(input, logger, cache, library)
     if output is not None:
         output.write(source.decode("UTF-8"))
     return llvm.run(source).decode("UTF-8")
 
-def compile(input:IOBase, output:IOBase, logger = logging.getLogger()):
-    output.write(_compile(input, logger).decode("UTF-8"))
+def compile(input:IOBase, output:IOBase, logger = logging.getLogger(), cache = False, library = False):
+    output.write(_compile(input, logger, cache, library).decode("UTF-8"))
 
 
@@ -1,6 +1,10 @@
+import os
 from enum import Enum
 import string
-from io import IOBase
+from array import array
+from bisect import bisect_left
+from io import IOBase, StringIO
+from concurrent.futures import ProcessPoolExecutor
 
 from ..errors import *
 
@@ -27,14 +31,6 @@ class Node:
                 out.append(target)
         return out
 
-    def getToken(self, start, stop, value):
-        if self.verify is not None:
-            value = self.verify(value)
-
-        if self.token_type is not None:
-            return Token(self.token_type, start, stop, value)
-        return None
-
     def __repr__(self):
         return "Node(token:{})".format(self.token_type, self.links)
 
@@ -207,6 +203,104 @@ node.links.append((end_node, lambda c: c in DIGIT_CHARACTERS))
 end_node.links.append((underscore_node, lambda c: c == "_"))
 end_node.links.append((end_node, lambda c: c in DIGIT_CHARACTERS))
 
+#
+# DFA
+#
+# The node tree above is a nondeterministic automaton, which is expensive to
+# simulate character by character. It is therefore compiled into a
+# deterministic state table through subset construction. Characters are
+# bucketed into classes of characters that every link condition treats the
+# same, so that the table only needs a column per class.
+#
+# A DFA state is the ordered list of nodes the original automaton would be in.
+# The order is kept, as the first node with a token type decides the token.
+
+# Returned by the state table when there is no transition
+DEAD = -1
+
+# Every link condition in the tree, used to compute character classes
+CONDITIONS = []
+
+DFA_NODES = [] # state -> (Node,)
+DFA_INDEX = {} # (Node,) -> state
+DFA_TABLE = [] # state -> [class -> state]
+DFA_ACCEPT = [] # state -> the Node producing the token, or None
+
+CHAR_CLASSES = {} # character -> class
+CLASS_SIGNATURES = {} # condition results -> class
+CLASS_CHARACTERS = [] # class -> representative character
+
+def _collectConditions(node, visited):
+    if node in visited: return
+    visited.add(node)
+
+    for target, condition in node.links:
+        CONDITIONS.append(condition)
+        _collectConditions(target, visited)
+
+# Return the class of a character, creating a new one if no existing class
+# behaves the same
+def charClass(char:str) -> int:
+    char_class = CHAR_CLASSES.get(char)
+    if char_class is None:
+        signature = tuple(bool(condition(char)) for condition in CONDITIONS)
+        char_class = CLASS_SIGNATURES.get(signature)
+
+        if char_class is None:
+            char_class = len(CLASS_CHARACTERS)
+            CLASS_SIGNATURES[signature] = char_class
+            CLASS_CHARACTERS.append(char)
+
+        CHAR_CLASSES[char] = char_class
+    return char_class
+
+# Return the state for a list of nodes, creating it if necessary
+def _dfaState(nodes:[Node]) -> int:
+    # Remove duplicates, keeping the first occurrence
+    nodes = tuple(dict.fromkeys(nodes))
+
+    state = DFA_INDEX.get(nodes)
+    if state is None:
+        state = len(DFA_NODES)
+        DFA_INDEX[nodes] = state
+        DFA_NODES.append(nodes)
+        DFA_TABLE.append([])
+        DFA_ACCEPT.append(next((node for node in nodes if node.token_type is not None), None))
+    return state
+
+# Return the state following a state for a character class
+def transition(state:int, char_class:int) -> int:
+    row = DFA_TABLE[state]
+    if char_class >= len(row):
+        row.extend([None] * (char_class + 1 - len(row)))
+
+    target = row[char_class]
+    if target is None:
+        char = CLASS_CHARACTERS[char_class]
+
+        next_nodes = []
+        for node in DFA_NODES[state]:
+            next_nodes += node.evaluate(char)
+
+        target = row[char_class] = _dfaState(next_nodes) if next_nodes else DEAD
+    return target
+
+_collectConditions(TREE, set())
+
+START = _dfaState([TREE])
+
+# Build the full table for ASCII up front. Other characters are added lazily,
+# but in practice share the class of an ASCII character
+for code in range(128):
+    charClass(chr(code))
+
+state = 0
+while state < len(DFA_NODES):
+    for char_class in range(len(CLASS_CHARACTERS)):
+        transition(state, char_class)
+    state += 1
+del state
+
 #
 # Lexer
 #
@@ -223,61 +317,414 @@ class Token:
             return str(self.type)
         return "{}({})".format(self.type, self.data)
 
+# Python predefines
+TokenView = None
+
+# A compact store of tokens
+#
+# Token types, positions and data are kept in parallel arrays rather than as
+# individual token objects. Data is interned, so that repeated identifiers and
+# keywords are only stored once. The store hands out TokenViews, which only
+# reference the store and an index into it.
+class TokenStore:
+    types = None
+    starts = None
+    ends = None
+    data = None
+
+    strings = None
+    string_ids = None
+
+    def __init__(self):
+        self.types = array("B")
+        self.starts = array("q")
+        self.ends = array("q")
+        self.data = array("L")
+
+        self.strings = []
+        self.string_ids = {}
+
+    # Add a token to the store, returning a view of it
+    def add(self, type:Tokens, start:int, end:int, data:str) -> TokenView:
+        self.types.append(type.value)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.data.append(self.intern(data))
+
+        return TokenView(self, len(self.types) - 1)
+
+    # Add the tokens of another store's arrays, whose data are indices into
+    # strings
+    def extend(self, types:array, starts:array, ends:array, strings:[str], data:array):
+        ids = [self.intern(string) for string in strings]
+
+        self.types.extend(types)
+        self.starts.extend(starts)
+        self.ends.extend(ends)
+        self.data.extend(map(ids.__getitem__, data))
+
+    # Returns the index of data in strings, adding it if needed
+    def intern(self, data:str) -> int:
+        data_id = self.string_ids.get(data)
+        if data_id is None:
+            data_id = self.string_ids[data] = len(self.strings)
+            self.strings.append(data)
+        return data_id
+
+    def __getitem__(self, index:int) -> TokenView:
+        if not -len(self) <= index < len(self):
+            raise IndexError("Token index out of range")
+        return TokenView(self, index % len(self))
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield TokenView(self, index)
+
+TOKEN_TYPES = {type.value: type for type in Tokens}
+
+# A lightweight reference to a token in a TokenStore
+class TokenView:
+    __slots__ = ("store", "index")
+
+    def __init__(self, store:TokenStore, index:int):
+        self.store = store
+        self.index = index
+
+    @property
+    def type(self):
+        return TOKEN_TYPES[self.store.types[self.index]]
+
+    @property
+    def start(self):
+        return self.store.starts[self.index]
+
+    @property
+    def end(self):
+        return self.store.ends[self.index]
+
+    @property
+    def data(self):
+        return self.store.strings[self.store.data[self.index]]
+
+    __repr__ = Token.__repr__
+
 class Lexer:
     source = None
-    current = None
-
-    def __init__(self, source:IOBase):
+    store = None
+    buffer = None
+    # The position of the start of the buffer in source
+    offset = 0
+    # The index of the current character in the buffer
+    index = 0
+
+    # Tokens lexed ahead of time in parallel, as the store they were added to
+    # and the range of their indices in it
+    pending = None
+    pending_index = 0
+    pending_stop = 0
+    # The error raised after the pending tokens, and the index at which
+    # lexing resumes after them
+    pending_error = None
+    pending_end = 0
+
+    # Tokens are added to store, if given, rather than created as Token objects
+    # If parallel is set, large sources are lexed in parallel up front
+    def __init__(self, source:IOBase, store:TokenStore = None, parallel = False):
         self.source = source
-        self.next()
+        self.store = store
 
-    # Read the next character into current
-    def next(self):
-        self.current = self.source.read(1)
+        # Read the remaining source into a single buffer up front. Tokens are
+        # sliced out of it and positions are plain offsets into it
+        self.offset = source.tell()
+        self.buffer = source.read()
+        self.index = 0
+
+        if parallel and len(self.buffer) >= PARALLEL_THRESHOLD and (os.cpu_count() or 1) > 1:
+            self.lexParallel()
 
     # Returns the current position in source
     @property
     def pos(self):
-        return self.source.tell()
+        return self.offset + self.index
 
     #
     # Lexing Methods
     #
 
+    # Lazily lex all tokens
+    def tokenize(self):
+        while True:
+            token = self.lex()
+            if token is None:
+                return
+            yield token
+
+    # Lex all remaining tokens into the store
+    def lexAll(self):
+        # Tokens lexed in parallel are in the store already
+        if self.pending is not None and self.pending is self.store:
+            self.pending_index = self.pending_stop
+
+        for token in self.tokenize(): pass
+
     # Lex a single token
     def lex(self):
-        token_start = self.pos - 1
-        token_data = ""
-        current_nodes = [TREE]
+        if self.pending is not None:
+            return self.nextPending()
+
+        return self.outputState(*self.scan())
+
+    # Run the state table over the next token
+    # Returns the final state and the start and end index of the token
+    def scan(self):
+        buffer = self.buffer
+        length = len(buffer)
+        index = self.index
+        token_start = index
+        state = START
+
+        while index < length:
+            try:
+                next_state = DFA_TABLE[state][CHAR_CLASSES[buffer[index]]]
+            except (KeyError, IndexError):
+                next_state = transition(state, charClass(buffer[index]))
+
+            if next_state == DEAD:
+                break
+            elif next_state == START:
+                # Restart
+                token_start = index + 1
+
+            index += 1
+            state = next_state
+
+        self.index = index
+        return state, token_start, index
+
+    # Returns the token for a final state as (type, start, end, data), or None
+    # at EOF
+    def acceptState(self, state, start, end):
+        node = DFA_ACCEPT[state]
+
+        if node is not None:
+            data = self.buffer[start:end]
+            if node.verify is not None:
+                data = node.verify(data)
+            return node.token_type, start, end, data
+
+        elif state == START and end == len(self.buffer):
+            return None
+
+        current = self.buffer[end:end + 1]
+        position = self.offset + min(end, len(self.buffer) - 1)
+        raise SyntaxError("Unexpected Character `{}`".format(current), [Token(None, position, position + 1)])
+
+    def outputState(self, state, start, end):
+        token = self.acceptState(state, start, end)
+        if token is None:
+            return None
+        return self.makeToken(*token)
 
+    # Create a token from indices into the buffer, adding it to store if given
+    def makeToken(self, type:Tokens, start:int, end:int, data:str, store:TokenStore = None):
+        # A token ending at EOF ends at the last character
+        start, end = self.offset + start, self.offset + min(end, len(self.buffer) - 1)
+
+        if store is None:
+            store = self.store
+        if store is not None:
+            return store.add(type, start, end, data)
+        return Token(type, start, end, data)
+
+    #
+    # Parallel Lexing
+    #
+    # Comments end at newlines, so only strings carry lexing state across
+    # lines. Large sources are therefore split into chunks at newlines, which
+    # are lexed in parallel as though each started at a token boundary. Where
+    # a chunk does not actually start at a token boundary, because a string
+    # spans into it, it is lexed serially until its tokens line up again.
+    #
+    # The token arrays of the chunks are copied into the store as they are.
+    # Only the tokens lexed serially are added one by one.
+
+    def lexParallel(self):
+        chunks = splitChunks(self.buffer, CHUNK_SIZE)
+        length = len(self.buffer)
+
+        # Without a store, tokens are kept in one of their own until output
+        self.pending = self.store if self.store is not None else TokenStore()
+        self.pending_index = len(self.pending)
+
+        # The index at which lexing continues
+        index = 0
+
+        with ProcessPoolExecutor() as executor:
+            results = executor.map(lexChunk, (self.buffer[start:end] for start, end in chunks),
+                                   (self.offset + start for start, end in chunks))
+
+            try:
+                for (start, end), (types, starts, ends, strings, data, failed) in zip(chunks, results):
+                    if index >= end: continue
+
+                    first = 0
+                    if index != start:
+                        first, index = self.lexUntilAligned(index, end, starts)
+                        if first is None: continue
+
+                    self.pending.extend(types[first:], starts[first:], ends[first:], strings, data[first:])
+
+                    if not failed:
+                        index = end
+                    elif first < len(types):
+                        index = ends[-1] - self.offset
+
+                # The last chunk may have failed before its end
+                index = self.lexUntilAligned(index, length, ())[1]
+
+            except SyntaxError as e:
+                self.pending_error = e
+                index = self.index
+
+        # A token ending at EOF ends at the last character
+        self.pending_stop = len(self.pending)
+        if self.pending_stop > self.pending_index:
+            ends = self.pending.ends
+            ends[-1] = min(ends[-1], self.offset + length - 1)
+
+        self.pending_end = index
+        self.index = 0
+
+    # Lex serially from index until a token starts where one of a chunk's
+    # tokens starts, or until the chunk is passed. starts are the positions of
+    # the chunk's tokens in order. Returns the index of the aligned chunk
+    # token, or None, and the index at which lexing continues
+    def lexUntilAligned(self, index:int, end:int, starts:array):
+        self.index = index
+        while self.index < end:
+            token = self.acceptState(*self.scan())
+            if token is None: break
+
+            start = self.offset + token[1]
+            position = bisect_left(starts, start)
+            if position < len(starts) and starts[position] == start:
+                return position, self.index
+            self.makeToken(*token, self.pending)
+        return None, self.index
+
+    def nextPending(self):
+        if self.pending_index < self.pending_stop:
+            token = TokenView(self.pending, self.pending_index)
+            self.pending_index += 1
+            self.index = token.end - self.offset
+
+            if self.store is None:
+                return Token(token.type, token.start, token.end, token.data)
+            return token
+
+        # Continue lexing serially
+        self.pending = None
+        self.index = self.pending_end
+
+        if self.pending_error is not None:
+            raise self.pending_error
+        return self.lex()
+
+# Sources at least this long are lexed in parallel, if enabled
+PARALLEL_THRESHOLD = 1 << 20
+# The approximate length of the chunks lexed in parallel
+CHUNK_SIZE = 1 << 16
+
+# Split source into chunks of about size, ending in newlines
+# Returns the start and end index of each chunk
+def splitChunks(source:str, size:int) -> [(int, int)]:
+    chunks = []
+
+    start = 0
+    while start < len(source):
+        end = source.find(NEWLINE_CHAR, start + size) + 1
+        if end == 0:
+            end = len(source)
+
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+# Lex a chunk of source on its own, as though it started at a token boundary
+# at position
+#
+# Returns the arrays of a token store, its strings, and whether lexing failed
+# before the end of the chunk. Ends are the positions at which lexing of each
+# token stopped.
+def lexChunk(chunk:str, position:int):
+    store = TokenStore()
+    failed = False
+
+    lexer = Lexer(StringIO(chunk))
+    try:
         while True:
-            next_nodes = []
+            token = lexer.acceptState(*lexer.scan())
+            if token is None: break
 
-            if self.current:
-                for node in current_nodes:
-                    next_nodes += node.evaluate(self.current)
+            type, start, end, data = token
+            store.add(type, start + position, end + position, data)
+    except SyntaxError:
+        failed = True
+    return store.types, store.starts, store.ends, store.strings, store.data, failed
 
-            if len(next_nodes) == 0:
-                if len(current_nodes) > 0:
-                    return self.outputNode(current_nodes, token_start, token_data)
-                raise InternalError("Zero current nodes in lex tree.")
+#
+# Incremental Lexing
+#
 
-            elif len(next_nodes) == 1 and next_nodes[0] is TREE:
-                # Restart
-                token_start = self.pos
-                token_data = ""
-                current_nodes = [TREE]
-            else:
-                token_data += self.current
-            self.next()
-
-            current_nodes = next_nodes
-        return None
-
-    def outputNode(self, nodes, start, data):
-        for node in nodes:
-            if node.token_type is not None:
-                return node.getToken(start, self.pos - 1, data)
-            elif node is TREE and not self.current:
-                return None
-        raise SyntaxError("Unexpected Character `{}`".format(self.current), [Token(None, self.pos - 1, self.pos)])
+# Re-lex source after replacing removed characters at offset with inserted
+#
+# tokens are the tokens of source before the edit. Only the tokens from the
+# last token boundary before the edit are re-lexed, until the new tokens line
+# up with the old ones again. The remaining old tokens are shifted to their
+# new positions. Returns the tokens of the edited source.
+def relex(source:str, tokens:[Token], offset:int, removed:int, inserted:str) -> [Token]:
+    edited = source[:offset] + inserted + source[offset + removed:]
+    shift = len(inserted) - removed
+
+    # Find the first token affected by the edit. A token is affected if the
+    # character ending it lies within or after the edit
+    low, high = 0, len(tokens)
+    while low < high:
+        middle = (low + high) // 2
+        if tokens[middle].end < offset:
+            low = middle + 1
+        else:
+            high = middle
+    # The previous token is re-lexed too, as it may now continue into the edit
+    first = max(low - 1, 0)
+
+    # Start lexing at the start of that token, or at the edit if it lies in
+    # the whitespace before it
+    lexer = Lexer(StringIO(edited))
+    if first < len(tokens):
+        lexer.index = min(tokens[first].start, offset)
+
+    new_tokens = tokens[:first]
+    old = first
+
+    while True:
+        token = lexer.lex()
+        if token is None:
+            return new_tokens
+
+        # Once a new token starts where an old token after the edit starts,
+        # the rest of the source lexes the same way
+        while old < len(tokens) and tokens[old].start + shift < token.start:
+            old += 1
+        if (old < len(tokens) and tokens[old].start >= offset + removed and
+                tokens[old].start + shift == token.start):
+            break
+
+        new_tokens.append(token)
+
+    for token in tokens[old:]:
+        new_tokens.append(Token(token.type, token.start + shift, token.end + shift, token.data))
+    return new_tokens
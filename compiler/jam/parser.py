@@ -1,22 +1,72 @@
+import os
 import logging
+import hashlib
 from io import IOBase
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 from .. errors import *
 from .. import lekvar
-from .lexer import Lexer, Tokens
+from .lexer import Lexer, TokenStore, TokenView, Tokens, TOKEN_TYPES
+from .cache import Cache
 
 #
 # Tools
 #
 
-def parseFile(source:IOBase, logger=logging.getLogger()):
+# If lazy is set, method bodies are only parsed once their instructions are
+# first needed. If parallel is set, large sources are lexed and their top level
+# definitions parsed in process pools. If fingerprint is set, the module gets
+# fingerprints of its definitions, for incremental verification. This parses
+# serially. If a cache is given, it is checked for the source first
+def parseFile(source:IOBase, logger=logging.getLogger(), lazy = False, parallel = False, cache:Cache = None, fingerprint = False):
+    if cache is None:
+        return _parseFile(source, logger, lazy, parallel, fingerprint)
+
+    # Positions of tokens depend on where the source starts
+    position = source.tell()
+    key = cache.key(source.read(), position, lazy, fingerprint)
+
+    module = cache.load(key)
+    if module is None:
+        source.seek(position)
+        module = _parseFile(source, logger, lazy, parallel, fingerprint)
+        cache.save(key, module)
+    return module
+
+def _parseFile(source:IOBase, logger, lazy, parallel, fingerprint = False):
     try:
-        return Parser(Lexer(source), logger).parseModule(False)
+        # Parsed objects keep their tokens. Keep those in a compact store
+        store = TokenStore()
+        lexer = Lexer(source, store, parallel=parallel)
+
+        if not parallel or fingerprint:
+            return Parser(lexer.tokenize(), logger, lazy, fingerprint).parseModule(False)
+
+        # Splitting the source requires all tokens up front
+        try:
+            lexer.lexAll()
+        except SyntaxError as error:
+            # Parse serially, so that any earlier parsing errors come first
+            def tokens():
+                yield from store
+                raise error
+            return Parser(tokens(), logger, lazy).parseModule(False)
+
+        if len(store) >= PARALLEL_THRESHOLD and (os.cpu_count() or 1) > 1:
+            return parseModuleParallel(store, logger, lazy)
+        return Parser(iter(store), logger, lazy).parseModule(False)
     except CompilerError as e:
         source.seek(0)
         e.format(source.read())
         raise e
 
+# Parse the instructions of a lazily parsed method body, from a range of
+# tokens in a store
+def parseLazyInstructions(store:TokenStore, start:int, end:int, tokens, logger):
+    parser = Parser((store[index] for index in range(start, end)), logger, True)
+    return parser.parseMethodInstructions(tokens)[0]
+
 #
 # Parser
 #
@@ -31,6 +81,9 @@ BINARY_OPERATIONS = [
 
 BINARY_OPERATION_TOKENS = {type for operation in BINARY_OPERATIONS for type in operation }
 
+BINARY_OPERATION_PRECEDENCES = {type: precedence
+    for precedence, operation in enumerate(BINARY_OPERATIONS) for type in operation}
+
 UNARY_OPERATIONS = [
     Tokens.addition,
     Tokens.subtraction,
@@ -39,28 +92,107 @@ UNARY_OPERATIONS = [
 
 UNARY_OPERATION_TOKENS = set(UNARY_OPERATIONS)
 
+# Token types which don't affect the meaning of a definition
+IGNORED_FINGERPRINT_TYPES = {Tokens.newline.value, Tokens.comment.value}
+
+# Tokens starting a block that is closed by `end`
+BLOCK_TOKENS = {
+    Tokens.def_kwd,
+    Tokens.new_kwd,
+    Tokens.class_kwd,
+    Tokens.module_kwd,
+    Tokens.if_kwd,
+    Tokens.while_kwd,
+    Tokens.loop_kwd,
+}
+
+# A cursor over a stream of tokens
+#
+# Tokens are pulled from the stream lazily and kept in a fixed size ring
+# buffer, so looking ahead and moving forward are constant time and memory
+# does not grow with the stream. Positions may be marked and later reset to,
+# as long as the tokens since the oldest mark still fit in the buffer.
+class TokenCursor:
+    tokens = None
+    buffer = None
+    mask = 0
+
+    # The absolute index of the next token
+    position = 0
+    # The absolute index after the last buffered token
+    end = 0
+    marks = None
+
+    # size must be a power of two
+    def __init__(self, tokens, size = 64):
+        if size & (size - 1):
+            raise InternalError("Token cursor size must be a power of two")
+
+        self.tokens = iter(tokens)
+        self.buffer = [None] * size
+        self.mask = size - 1
+        self.marks = []
+
+    # Buffer tokens up to an absolute index. Past the end of the stream, None
+    # is buffered
+    def fill(self, end:int):
+        while self.end < end:
+            oldest = self.marks[0] if self.marks else self.position
+            if self.end - oldest > self.mask:
+                raise InternalError("Token lookahead exceeds the cursor buffer")
+
+            self.buffer[self.end & self.mask] = next(self.tokens, None)
+            self.end += 1
+
+    # Return the next token and move forward by one token
+    def next(self):
+        self.fill(self.position + 1)
+        token = self.buffer[self.position & self.mask]
+        self.position += 1
+        return token
+
+    # Look ahead of the current token by num tokens
+    def lookAhead(self, num = 1):
+        self.fill(self.position + num)
+        return self.buffer[(self.position + num - 1) & self.mask]
+
+    # Remember the current position
+    def mark(self):
+        self.marks.append(self.position)
+
+    # Move back to the last marked position, forgetting the mark
+    def reset(self):
+        self.position = self.marks.pop()
+
+    # Forget the last marked position, without moving back
+    def release(self):
+        self.marks.pop()
+
 class Parser:
-    lexer = None
     tokens = None
     logger = None
-
-    def __init__(self, lexer, logger):
-        self.lexer = lexer
-        self.tokens = []
+    lazy = False
+    # Hashes of the tokens of each top level definition, by name
+    fingerprints = None
+
+    # If lazy is set, the bodies of methods are skipped and only parsed once
+    # their instructions are needed. This requires tokens from a TokenStore.
+    # If fingerprint is set, top level definitions are fingerprinted, which
+    # also requires tokens from a TokenStore
+    def __init__(self, tokens, logger, lazy = False, fingerprint = False):
+        self.tokens = TokenCursor(tokens)
         self.logger = logger.getChild("Parser")
+        self.lazy = lazy
+        if fingerprint:
+            self.fingerprints = {}
 
     # Return the next token and move forward by one token
     def next(self):
-        if len(self.tokens) == 0:
-            return self.lexer.lex()
-        else:
-            return self.tokens.pop(0)
+        return self.tokens.next()
 
     # Look ahead of the current token by num tokens
     def lookAhead(self, num = 1):
-        while len(self.tokens) < num:
-            self.tokens.append(self.lexer.lex())
-        return self.tokens[num - 1]
+        return self.tokens.lookAhead(num)
 
     # Throw an unexpected token error
     def _unexpected(self, token):
@@ -120,6 +252,7 @@ class Parser:
                     tokens.append(self.next())
                     break
 
+            first = self.lookAhead()
             value = self.parseLine()
 
             # EOF escape
@@ -128,11 +261,36 @@ class Parser:
             if isinstance(value, lekvar.BoundObject):
                 # Scopes are automatically added as children
                 self.addChild(children, value)
+
+                if not inline and self.fingerprints is not None:
+                    self.addFingerprint(value.name, first)
             else:
                 # Other values are added as instructions
                 instructions.append(value)
 
-        return lekvar.Module(module_name, list(children.values()), instructions, tokens)
+        module = lekvar.Module(module_name, list(children.values()), instructions, tokens)
+
+        if not inline and self.fingerprints is not None:
+            module.fingerprints = {name: hash.hexdigest() for name, hash in self.fingerprints.items()}
+        return module
+
+    # Add the tokens from first up to the next token to the fingerprint of a
+    # definition. Newlines and comments don't change fingerprints
+    def addFingerprint(self, name:str, first:TokenView):
+        hash = self.fingerprints.get(name)
+        if hash is None:
+            hash = self.fingerprints[name] = hashlib.sha256()
+
+        store = first.store
+        following = self.lookAhead()
+        end = following.index if following is not None else len(store)
+
+        for index in range(first.index, end):
+            type = store.types[index]
+            if type in IGNORED_FINGERPRINT_TYPES: continue
+            hash.update(bytes((type,)))
+            hash.update(store.strings[store.data[index]].encode("UTF-8"))
+            hash.update(b"\0")
 
     def parseLine(self):
         # Parse a line. The line may not exist
@@ -158,54 +316,26 @@ class Parser:
             return self.parseBreak()
         return self.parseValue()
 
-    def parseValue(self):
-        values = [self.parseUnaryOperation()]
-        operations = []
+    # Parse a value, including binary operations of at least a precedence
+    #
+    # Uses precedence climbing: operations of higher precedence are parsed as
+    # the right hand side of lower ones, operations of the same precedence
+    # are accumulated left to right.
+    def parseValue(self, precedence = 0):
+        lhs = self.parseUnaryOperation()
 
         while True:
             token = self.strip([Tokens.comment, Tokens.newline])
 
-            if token and token.type in BINARY_OPERATION_TOKENS:
-                operations.append(self.next())
-                values.append(self.parseUnaryOperation())
-            else:
+            if token is None or token.type not in BINARY_OPERATION_TOKENS:
+                break
+
+            operation_precedence = BINARY_OPERATION_PRECEDENCES[token.type]
+            if operation_precedence < precedence:
                 break
 
-        return self.parseBinaryOperation(values, operations)
-
-    def parseBinaryOperation(self, values, operations, operation_index = 0):
-        if len(values) == 1:
-            return values[0]
-
-        if operation_index == len(BINARY_OPERATIONS):
-            raise InternalError("Unparsed operation {}".format(values))
-
-        # Accumulate values from higher order operations
-        # Separated by current order operations
-        operation_values = []
-        operation_operations = []
-
-        previous_index = 0
-        for index, operation in enumerate(operations):
-            if operation.type in BINARY_OPERATIONS[operation_index]:
-                operation_operations.append(operation)
-
-                operation_values.append(self.parseBinaryOperation(
-                    values[previous_index:index + 1],
-                    operations[previous_index:index],
-                    operation_index + 1,
-                ))
-                previous_index = index + 1
-        operation_values.append(self.parseBinaryOperation(
-            values[previous_index:],
-            operations[previous_index:],
-            operation_index + 1,
-        ))
-
-        # Accumulate operations (left to right)
-        lhs = operation_values[0]
-        for index, operation in enumerate(operation_operations):
-            rhs = operation_values[index + 1]
+            operation = self.next()
+            rhs = self.parseValue(operation_precedence + 1)
             lhs = lekvar.Call(lekvar.Attribute(lhs, operation.data), [rhs], operation)
 
         return lhs
@@ -398,19 +528,11 @@ class Parser:
         return self.parseMethodBody(name, arguments, default_values, None, tokens)
 
     def parseMethodBody(self, name, arguments, default_values, return_type, tokens):
-        # Parse instructions
-        instructions = []
-
-        while True:
-            token = self.strip()
-
-            if token is None:
-                raise SyntaxError("Expected `end` before EOF for method", tokens)
-
-            if token.type == Tokens.end_kwd:
-                tokens.append(self.next())
-                break
-            instructions.append(self.parseLine())
+        if self.lazy and isinstance(self.lookAhead(), TokenView):
+            instructions = self.skipMethodInstructions(tokens)
+        else:
+            instructions, end = self.parseMethodInstructions(tokens)
+            tokens.append(end)
 
         # Create method with default arguments
         overloads = [lekvar.Function("", arguments, instructions, return_type, tokens)]
@@ -442,6 +564,43 @@ class Parser:
 
         return lekvar.Method(name, overloads)
 
+    # Parse instructions up to and including `end`
+    # Returns the instructions and the end token
+    def parseMethodInstructions(self, tokens):
+        instructions = []
+
+        while True:
+            token = self.strip()
+
+            if token is None:
+                raise SyntaxError("Expected `end` before EOF for method", tokens)
+
+            if token.type == Tokens.end_kwd:
+                return instructions, self.next()
+            instructions.append(self.parseLine())
+
+    # Skip instructions up to and including the matching `end`
+    # Returns a function parsing the skipped instructions
+    def skipMethodInstructions(self, tokens):
+        first = self.lookAhead()
+
+        depth = 1
+        while depth > 0:
+            token = self.next()
+
+            if token is None:
+                raise SyntaxError("Expected `end` before EOF for method", tokens)
+
+            if token.type in BLOCK_TOKENS:
+                depth += 1
+            elif token.type == Tokens.end_kwd:
+                depth -= 1
+        tokens.append(token)
+
+        # Only keep the range of skipped tokens
+        return partial(parseLazyInstructions, first.store, first.index, token.index + 1,
+            tokens, self.logger.parent)
+
     def parseMethodArguments(self):
         arguments, default_values = [], []
 
@@ -679,3 +838,147 @@ class Parser:
 
         attribute = self.expect(Tokens.identifier).data
         return lekvar.Attribute(value, attribute, tokens)
+
+#
+# Parallel Parsing
+#
+# Top level definitions are syntactically independent once their extent is
+# known. A cheap scan over the tokens splits a module into segments of single
+# definitions and the other lines in between, which are parsed in parallel and
+# then added to the module in order.
+
+# Sources with at least this many tokens are parsed in parallel, if enabled
+PARALLEL_THRESHOLD = 1 << 16
+
+# Tokens starting a top level definition
+DEFINITION_TOKENS = {Tokens.def_kwd, Tokens.class_kwd, Tokens.module_kwd}
+
+# Tokens after which a value continues, possibly with a definition
+CONTINUATION_TOKENS = BINARY_OPERATION_TOKENS | UNARY_OPERATION_TOKENS | {
+    Tokens.equal,
+    Tokens.typeof,
+    Tokens.returns,
+    Tokens.comma,
+    Tokens.dot,
+    Tokens.group_start,
+    Tokens.return_kwd,
+}
+
+# Tokens after a value which continue it
+FOLLOWING_TOKENS = BINARY_OPERATION_TOKENS | {Tokens.group_start, Tokens.dot}
+
+def parseModuleParallel(store:TokenStore, logger:logging.Logger, lazy = False):
+    segments = splitTopLevel(store)
+
+    def segmentTokens(start, end):
+        return (store.types[start:end], store.starts[start:end], store.ends[start:end],
+            [store.strings[data] for data in store.data[start:end]])
+
+    parser = Parser((), logger, lazy)
+    children = {}
+    instructions = []
+
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(partial(parseSegment, lazy=lazy),
+            (segmentTokens(start, end) for start, end in segments))
+
+        for (start, end), values in zip(segments, results):
+            # Parse failed segments again, to raise their error here
+            if values is None:
+                values = parseSegment(segmentTokens(start, end), lazy, True)
+
+            for value in values:
+                if isinstance(value, lekvar.BoundObject):
+                    parser.addChild(children, value)
+                else:
+                    instructions.append(value)
+
+    return lekvar.Module("main", list(children.values()), instructions, [])
+
+# Split the tokens of a module into segments, such that each top level
+# definition is in its own segment. Returns the start and end index of each
+# segment
+def splitTopLevel(store:TokenStore) -> [(int, int)]:
+    types = [TOKEN_TYPES[type] for type in store.types]
+
+    segments = []
+    segment_start = 0
+
+    depth = 0
+    group_depth = 0
+    # The last token that isn't a newline or comment
+    previous = None
+
+    index = 0
+    while index < len(types):
+        type = types[index]
+
+        # Definitions start a new line, unless a value continues into them
+        if (type in DEFINITION_TOKENS and depth == 0 and group_depth == 0 and
+                previous not in CONTINUATION_TOKENS):
+            end = _findBlockEnd(types, index)
+
+            if end is not None:
+                # Newlines and comments after the definition are skipped by
+                # the parser while checking for a continuing value
+                while end < len(types) and types[end] in (Tokens.newline, Tokens.comment):
+                    end += 1
+
+                if end == len(types) or types[end] not in FOLLOWING_TOKENS:
+                    if segment_start < index:
+                        segments.append((segment_start, index))
+                    segments.append((index, end))
+
+                    segment_start = index = end
+                    previous = None
+                    continue
+
+        if type in BLOCK_TOKENS:
+            depth += 1
+        elif type == Tokens.end_kwd:
+            depth -= 1
+        elif type == Tokens.group_start:
+            group_depth += 1
+        elif type == Tokens.group_end:
+            group_depth -= 1
+
+        if type not in (Tokens.newline, Tokens.comment):
+            previous = type
+        index += 1
+
+    if segment_start < len(types):
+        segments.append((segment_start, len(types)))
+    return segments
+
+# Returns the index after the `end` closing the block at index, or None
+def _findBlockEnd(types:[Tokens], index:int):
+    depth = 0
+    while index < len(types):
+        if types[index] in BLOCK_TOKENS:
+            depth += 1
+        elif types[index] == Tokens.end_kwd:
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        index += 1
+    return None
+
+# Parse the lines of a segment of tokens, given as arrays of their types,
+# starts, ends and data. Returns the parsed values, or None if parsing failed
+# and raise_errors isn't set
+def parseSegment(tokens, lazy = False, raise_errors = False):
+    store = TokenStore()
+    for type, start, end, data in zip(*tokens):
+        store.add(TOKEN_TYPES[type], start, end, data)
+
+    parser = Parser(iter(store), logging.getLogger(), lazy)
+    values = []
+    try:
+        while True:
+            value = parser.parseLine()
+            if value is None: break
+            values.append(value)
+    except CompilerError:
+        if raise_errors: raise
+        return None
+    return values
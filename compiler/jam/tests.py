@@ -1,5 +1,6 @@
 import sys
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 import logging
@@ -7,7 +8,9 @@ import logging
 from . import lexer
 from . import parser
 from . import compiler
+from . import cache as parse_cache
 from .. import lekvar
+from .. import errors
 from ..llvm import emitter as llvm
 from ..llvm.builtins import builtins
 
@@ -70,6 +73,387 @@ defend+_- end"""
             assert token is not None
             assert token.type == output
 
+def test_token_store():
+    test = """def foo(a, b) # foo
+  return foo(a + 1_0, `b`)
+end"""
+    with StringIO(test) as input:
+        tokens = list(iter(lexer.Lexer(input).lex, None))
+
+    store = lexer.TokenStore()
+    with StringIO(test) as input:
+        views = list(iter(lexer.Lexer(input, store).lex, None))
+
+    assert len(store) == len(tokens)
+    for token, view in zip(tokens, views):
+        assert (view.type, view.start, view.end, view.data) == (token.type, token.start, token.end, token.data)
+
+    # Repeated data is only stored once
+    assert store.strings.count("foo") == 1
+
+def test_relex():
+    source = """def foo(a)
+  return a + 1
+end
+puts(foo(2))"""
+    edits = [
+        (source.index("a +"), 1, "bar"),
+        (source.index("1"), 1, "`x y`"),
+        (len(source), 0, "\n"),
+        (0, 0, "  "),
+        (source.index("(2)"), 3, ""),
+    ]
+
+    def lex(source):
+        with StringIO(source) as input:
+            return list(iter(lexer.Lexer(input).lex, None))
+
+    tokens = lex(source)
+    for offset, removed, inserted in edits:
+        edited = source[:offset] + inserted + source[offset + removed:]
+
+        expected = [(token.type, token.start, token.end, token.data) for token in lex(edited)]
+        output = lexer.relex(source, tokens, offset, removed, inserted)
+        assert [(token.type, token.start, token.end, token.data) for token in output] == expected
+
+def test_parallel_lexer(monkeypatch):
+    source = """def foo(a)
+  # a comment "
+  return "a
+multiline" + `string
+` + a
+end
+puts(foo(`2`))"""
+
+    monkeypatch.setattr(lexer, "PARALLEL_THRESHOLD", 0)
+    monkeypatch.setattr(lexer, "CHUNK_SIZE", 1)
+    monkeypatch.setattr(lexer.os, "cpu_count", lambda: 2)
+
+    with StringIO(source) as input:
+        expected = [(token.type, token.start, token.end, token.data)
+            for token in lexer.Lexer(input).tokenize()]
+
+    with StringIO(source) as input:
+        output = [(token.type, token.start, token.end, token.data)
+            for token in lexer.Lexer(input, parallel=True).tokenize()]
+
+    assert output == expected
+
+    # Chunks are copied into the store
+    store = lexer.TokenStore()
+    with StringIO(source) as input:
+        lexer.Lexer(input, store, parallel=True).lexAll()
+
+    assert [(token.type, token.start, token.end, token.data) for token in store] == expected
+
+def test_token_cursor():
+    cursor = parser.TokenCursor(range(10), 4)
+
+    assert cursor.next() == 0
+    assert cursor.lookAhead(3) == 3
+
+    cursor.mark()
+    assert [cursor.next() for _ in range(3)] == [1, 2, 3]
+    cursor.reset()
+    assert cursor.next() == 1
+
+    # Lookahead is bounded by the buffer size
+    with pytest.raises(errors.InternalError):
+        cursor.lookAhead(5)
+
+    assert [cursor.next() for _ in range(10)] == [2, 3, 4, 5, 6, 7, 8, 9, None, None]
+
+def test_lazy_parsing():
+    source = """def foo(a:Int, b:Int = 2)
+  if a
+    return b + 1
+  end
+  return a * b
+end
+foo(1)"""
+
+    def foo(lazy):
+        with StringIO(source) as input:
+            module = parser.parseFile(input, lazy=lazy)
+        return [overload for overload in module.context["foo"].overload_context]
+
+    lazy, eager = foo(True), foo(False)
+
+    # Bodies are only parsed when first needed
+    assert lazy[0].load_instructions is not None
+    for lazy_overload, eager_overload in zip(lazy, eager):
+        assert repr(lazy_overload.instructions) == repr(eager_overload.instructions)
+    assert lazy[0].load_instructions is None
+
+def test_parallel_parser(monkeypatch):
+    monkeypatch.setattr(parser, "PARALLEL_THRESHOLD", 0)
+    monkeypatch.setattr(parser.os, "cpu_count", lambda: 2)
+
+    with open(BUILTIN, "r") as f:
+        source = f.read() + "\nputs(1)\ndef puts(value:Bool) # overload\nend\n"
+
+    serial = parser.parseFile(StringIO(source))
+    parallel = parser.parseFile(StringIO(source), parallel=True)
+
+    assert repr(list(parallel.context)) == repr(list(serial.context))
+    assert repr(parallel.main) == repr(serial.main)
+    assert len(parallel.context["puts"].overload_context) == 4
+
+    # Process pools are only started when parallel is set
+    monkeypatch.setattr(lexer, "PARALLEL_THRESHOLD", 0)
+    monkeypatch.setattr(lexer, "ProcessPoolExecutor", None)
+    monkeypatch.setattr(parser, "ProcessPoolExecutor", None)
+    assert repr(parser.parseFile(StringIO(source)).main) == repr(serial.main)
+
+def test_parse_cache(tmpdir, monkeypatch):
+    cache = parse_cache.Cache(str(tmpdir))
+
+    with open(BUILTIN, "r") as f:
+        parsed = parser.parseFile(f, cache=cache)
+    with open(BUILTIN, "r") as f:
+        cached = parser.parseFile(f, cache=cache)
+
+    assert len(tmpdir.listdir()) == 1
+    assert cached is not parsed
+    assert repr(list(cached.context)) == repr(list(parsed.context))
+
+    # The cache is bounded in size
+    cache.max_size = tmpdir.listdir()[0].size()
+    parser.parseFile(StringIO("puts(1)"), cache=cache)
+    assert len(tmpdir.listdir()) == 1
+
+    # Entries of other versions of the compiler are never used
+    key = cache.key("puts(1)")
+    monkeypatch.setattr(parse_cache, "_compiler_hash", b"other")
+    assert cache.key("puts(1)") != key
+
+def test_builtins_snapshot(tmpdir, monkeypatch):
+    monkeypatch.setattr(compiler, "_snapshot", None)
+    cache = parse_cache.Cache(str(tmpdir))
+
+    first = compiler.loadBuiltins(cache)
+    second = compiler.loadBuiltins(cache)
+    assert first is not second
+    assert repr(list(first.context)) == repr(list(second.context))
+
+    # Not even the LLVM types are shared
+    for builtins in (first, second):
+        int64 = builtins.context["_builtins"].context["Int64"]
+        assert int64.bound_context.scope is builtins.context["_builtins"]
+
+    # The snapshot is reloaded from the cache by new processes
+    monkeypatch.setattr(compiler, "_snapshot", None)
+    assert repr(list(compiler.loadBuiltins(cache).context)) == repr(list(first.context))
+
+def test_lazy_builtins():
+    builtins = compiler.builtins()
+    ir = parser.parseFile(StringIO("puts(1 + 2)"))
+    lekvar.verify(ir, builtins)
+
+    int = builtins.context["Int"]
+    assert int.instance_context["+"].verified
+    assert int.instance_context["+"].overload_context["0"].verified
+    assert not int.instance_context["*"].overload_context["0"].verified
+    assert not builtins.context["Real"].instance_context["+"].verified
+
+def test_symbol_table():
+    # Memoized references see variables added by later assignments
+    ir = parser.parseFile(StringIO("def f()\n  a = 1\n  a = a + 1\n  return a\nend\nputs(f())"))
+    lekvar.verify(ir, compiler.builtins())
+    assert len(ir.context["f"].overload_context["0"].local_context) == 1
+
+    ir = parser.parseFile(StringIO("def puts()\nend\nputs(1)"))
+    with pytest.raises(errors.AmbiguityError):
+        lekvar.verify(ir, compiler.builtins())
+
+def test_template_instances(monkeypatch):
+    source = "def id(x)\n  return x\nend\nputs(id(1))\nputs(id(\"a\"))\nputs(id(2))\nputs(id(id(3)))"
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    template = ir.context["id"].overload_context["0"]
+    assert (template.instance_hits, template.instance_misses) == (3, 2)
+    assert ir.main[0].values[0].function is ir.main[2].values[0].function
+
+    # Instances are bounded in number
+    monkeypatch.setattr(lekvar.function, "INSTANCE_CACHE_SIZE", 1)
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    template = ir.context["id"].overload_context["0"]
+    assert len(template.instances) == 1
+
+def test_template_sharing():
+    source = "def f(x)\n  # comment\n  puts(1)\n  return x\nend\nputs(f(1))"
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    template = ir.context["f"].overload_context["0"]
+    instance = ir.main[0].values[0].function
+
+    # Only parts which depend on the arguments are copied
+    assert instance.instructions[0] is template.instructions[0]
+    assert instance.instructions[1].called is template.instructions[1].called
+    assert instance.instructions[2].value is not template.instructions[2].value
+
+def test_overload_dispatch():
+    builtins = compiler.builtins()
+    ir = parser.parseFile(StringIO("puts(1)\nputs(\"a\")\nputs(2)"))
+    lekvar.verify(ir, builtins)
+
+    puts = builtins.context["puts"]
+    assert len(puts.dispatch.cache) == 2
+    assert ir.main[0].function is ir.main[2].function
+    assert ir.main[0].function is not ir.main[1].function
+
+def test_concurrent_verification():
+    sources = ["puts(1 + 2)", "def f(a:Int)\n  return a * 2\nend\nputs(f(2))", "puts(1.0 - 2.0)"] * 8
+
+    def verify(source):
+        ir = parser.parseFile(StringIO(source))
+        lekvar.verify(ir, compiler.builtins())
+        return repr(ir.main)
+
+    expected = list(map(verify, sources))
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(verify, sources)) == expected
+
+    # Every emission has its own LLVM context, so whole compilations may run
+    # concurrently as well
+    def compile(source):
+        output = StringIO()
+        compiler.compile(StringIO(source), output)
+        return output.getvalue()
+
+    expected = list(map(compile, sources))
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(compile, sources)) == expected
+    assert llvm.run(expected[1].encode("UTF-8")) == b"4\n"
+
+def test_deep_verification():
+    # A chain of calls longer than Python's default recursion limit
+    count = 2000
+    source = "".join("def f{}() -> Int\n  return f{}()\nend\n".format(i, i + 1) for i in range(count))
+    source += "def f{}() -> Int\n  return 1\nend\nputs(f0())".format(count)
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    assert ir.context["f0"].overload_context["0"].verified
+
+    # Or of functions with inferred return types, which are verified as they
+    # are called
+    source = "def f0()\n  return 1\nend\n"
+    source += "".join("def f{}()\n  return f{}()\nend\n".format(i + 1, i) for i in range(count))
+    source += "puts(f{}())\n".format(count)
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    assert ir.context["f0"].overload_context["0"].type.return_type is not None
+
+    # A sum longer than the default recursion limit
+    source = "a = 1\nputs(" + " + ".join(["a"] * count) + ")\n"
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    assert ir.main[-1].values[0].function is not None
+
+def test_incremental_verification():
+    source = "def f()\n  return 1\nend\ndef g()\n  return f()\nend\ndef h()\n  return 2\nend\nputs(g() + h())\n"
+    builtins = compiler.builtins()
+
+    previous = parser.parseFile(StringIO(source), fingerprint=True)
+    lekvar.verify(previous, builtins)
+    assert llvm.run(llvm.emit(previous)) == b"3\n"
+    f, g, h = (previous.context[name] for name in "fgh")
+
+    ir = parser.parseFile(StringIO(source.replace("1", "3")), fingerprint=True)
+    lekvar.reverify(ir, previous, builtins)
+    # Reused definitions and builtins are emitted into the new module
+    assert llvm.run(llvm.emit(ir)) == b"5\n"
+
+    # Only the changed definition and its dependents are verified again
+    assert ir.context["h"] is h
+    assert ir.context["f"] is not f
+    assert ir.context["g"] is not g
+    assert "f" in ir.dependencies["g"]
+
+def test_tree_shaking():
+    source = "def f()\nend\ndef g()\n  f()\nend\ndef h()\n  puts(undefined)\nend\ng()"
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    assert ir.context["f"].verified
+    assert not ir.context["h"].verified
+
+    # Nor are their bodies parsed
+    ir = parser.parseFile(StringIO(source), lazy=True)
+    lekvar.verify(ir, compiler.builtins())
+    assert list(ir.context["h"].overload_context)[0].load_instructions is not None
+
+    # Libraries keep all definitions
+    ir = parser.parseFile(StringIO(source))
+    with pytest.raises(errors.MissingReferenceError):
+        lekvar.verify(ir, compiler.builtins(), library=True)
+
+def test_constant_folding():
+    source = "puts(60 * 60 * 24)\nputs(-7 // 2)\nputs(1.5 / 2.0)\na = !(1 < 2)\nputs(1 // 0)\n"
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    constants = [instruction.values[0].constant for instruction in ir.main[:3]]
+    assert [constant.data for constant in constants] == [86400, -3, 0.75]
+    assert ir.main[3].value.constant.data is False
+
+    # Folded literals span the whole operation
+    assert [token.data for token in constants[0].tokens] == ["60", "*", "60", "*", "24"]
+
+    # Division by zero is left to run time
+    assert ir.main[4].values[0].constant is None
+
+def test_inlining():
+    source = "def f(a:Int, b:Int)\n  return a * b\nend\ndef g(a:Int, b:Int)\n  return b - a\nend\nputs(f(2, 3) + 1)\nputs(g(f(1, 2), f(3, 4)))\n"
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+
+    # Operators are inlined down to builtin instructions
+    call = ir.main[0].values[0]
+    assert isinstance(call.inlined.values[0].function, lekvar.ExternalFunction)
+    assert call.called.value.inlined.constant.data == 6
+
+    # Arguments may not be evaluated out of order
+    assert ir.main[1].values[0].inlined is None
+
+    # Nor after calls which may change them
+    source = "x = 1\ndef bump() -> Int\n  x = x + 1\n  return x\nend\ndef f(a:Int) -> Int\n  return bump() + a\nend\nputs(f(x))\n"
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    assert ir.main[-1].values[0].inlined is None
+
+    # Locals assigned trivial values are substituted, but branches are kept
+    source = "def f(a:Int) -> Int\n  zero = 0\n  return zero - a\nend\ndef g(a:Bool) -> Bool\n  if a\n    return false\n  end\n  return true\nend\nputs(f(2))\nb = g(true)\nc = 3\nputs(-c)\n"
+
+    ir = parser.parseFile(StringIO(source))
+    lekvar.verify(ir, compiler.builtins())
+    assert ir.main[0].values[0].inlined.constant.data == -2
+    assert ir.main[1].value.inlined is None
+    assert ir.main[3].values[0].inlined is not None
+
+def test_unboxing():
+    source = "i = 0\ntotal = 0\nwhile i < 10\n  total = total + i * 2\n  i = i + 1\nend\nputs(total)\n"
+
+    output = StringIO()
+    compiler.compile(StringIO(source), output)
+    ir = output.getvalue()
+    main = ir[ir.index("define i32 @main"):]
+    main = main[:main.index("\n}")]
+
+    # Builtin values are scalars, and their operations are emitted in place
+    assert "{ i64 }" not in main and "{ i1 }" not in main
+    assert "extractvalue" not in main and "insertvalue" not in main
+    assert "mul i64" in main and "add i64" in main and "icmp slt i64" in main
+    assert main.count("call ") == main.count("@lekvar.puts")
+
 def test_builtin_lib(verbosity):
     logging.basicConfig(level=logging.WARNING - verbosity*10, stream=sys.stdout)
 
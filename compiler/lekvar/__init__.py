@@ -1,7 +1,10 @@
+import sys
 import logging
+import threading
 from io import IOBase
+from contextvars import copy_context
 
-from ..errors import CompilerError
+from ..errors import CompilerError, SemanticError
 
 from .state import State
 from .core import Context, Object, BoundObject, Type
@@ -18,16 +21,106 @@ from .literal import Literal
 from .branches import Loop, Break, Branch
 from .comment import Comment
 
-def verify(module:Module, builtin:Module, logger = logging.getLogger(), source:IOBase = None):
-    # Set up the initial state before verifying
-    State.init(builtin, logger.getChild("lekvar"))
+# Verification recurses about as deeply as programs are nested, such as through
+# chains of functions with inferred return types. It runs on a thread of its
+# own, with a stack large enough for this many nested Python frames
+RECURSION_LIMIT = 1 << 19
+STACK_SIZE = 1 << 29
 
-    State.logger.info(module.context)
+# The stack size of new threads is global, so it is only changed by one
+# thread at a time
+_stack_size_lock = threading.Lock()
 
-    try:
-        module.verify()
-    except CompilerError as e:
-        if source is not None:
-            source.seek(0)
-            e.format(source.read())
-        raise e
+# Definitions unreachable from the main instructions are only verified for
+# libraries, such as the builtins
+def verify(module:Module, builtin:Module, logger = logging.getLogger(), source:IOBase = None, library:bool = False):
+    if sys.getrecursionlimit() < RECURSION_LIMIT:
+        sys.setrecursionlimit(RECURSION_LIMIT)
+
+    errors = []
+    def run():
+        try:
+            _verify(module, builtin, logger, source, library)
+        except BaseException as e:
+            errors.append(e)
+
+    with _stack_size_lock:
+        stack_size = threading.stack_size(STACK_SIZE)
+        try:
+            thread = threading.Thread(target=copy_context().run, args=(run,), name="lekvar.verify")
+            thread.start()
+        finally:
+            threading.stack_size(stack_size)
+    thread.join()
+
+    if errors:
+        raise errors[0]
+
+def _verify(module:Module, builtin:Module, logger:logging.Logger, source:IOBase, library:bool):
+    # Set up the initial state before verifying. Builtins are only verified
+    # as they are used, unless they are what is being verified
+    with State.begin(module, builtin, logger.getChild("lekvar"), module is not builtin, library or module is builtin):
+        State.logger.info(module.context)
+
+        try:
+            try:
+                module.verify()
+                State.verifyScheduled()
+
+                # Calls are inlined once all functions they may call are
+                # verified
+                for call in State.calls:
+                    call.inline()
+            except RecursionError:
+                raise SemanticError("Program is nested too deeply to verify")
+        except CompilerError as e:
+            if source is not None:
+                source.seek(0)
+                e.format(source.read())
+            raise e
+
+        module.dependencies = State.dependencies
+
+# Verify a module replacing a previously verified one, which must have been
+# verified with the same builtins. Definitions with unchanged fingerprints, which
+# don't depend on changed definitions, are taken from the previous module along
+# with their verification.
+def reverify(module:Module, previous:Module, builtin:Module, logger = logging.getLogger(), source:IOBase = None, library:bool = False):
+    reused = set()
+    if None not in (module.fingerprints, previous.fingerprints, previous.dependencies):
+        reused = reusableDefinitions(module, previous)
+
+    for name in reused:
+        module.context.addChild(previous.context[name])
+
+    verify(module, builtin, logger, source, library)
+
+    # Reused definitions keep their dependencies
+    for name in reused:
+        if name in previous.dependencies:
+            module.dependencies[name] = previous.dependencies[name]
+
+# Returns the names of the definitions of a previous module which are still valid
+# for a module replacing it
+def reusableDefinitions(module:Module, previous:Module) -> {str}:
+    # Definitions which were added, removed or changed
+    changed = {name for name in module.fingerprints.keys() | previous.fingerprints.keys()
+               if module.fingerprints.get(name) != previous.fingerprints.get(name)}
+    # Objects added during verification, such as global variables, are new for
+    # every verification
+    changed |= {child.name for child in previous.context if child.name not in previous.fingerprints}
+
+    dependents = {}
+    for name, dependencies in previous.dependencies.items():
+        for dependency in dependencies:
+            dependents.setdefault(dependency, []).append(name)
+
+    # Invalidate all transitive dependents of changed definitions
+    stack = list(changed)
+    while stack:
+        for dependent in dependents.get(stack.pop(), []):
+            if dependent not in changed:
+                changed.add(dependent)
+                stack.append(dependent)
+
+    return set(previous.fingerprints) - changed
@@ -4,6 +4,7 @@ from .state import State
 from .core import Context, Object, BoundObject, Type
 from .function import Function
 from .module import Module
+from .util import copy
 
 #
 # Loop
@@ -19,7 +20,7 @@ class Loop(Object):
         self.instructions = instructions
 
     def copy(self):
-        return Loop(self.instructions)
+        return Loop(list(map(copy, self.instructions)))
 
     def verify(self):
         if not isinstance(State.scope, (Function, Module)):
@@ -72,7 +73,7 @@ class Branch(Object):
         self.false_instructions = false_instructions
 
     def copy(self):
-        return Branch(self.condition, self.true_instructions, self.false_instructions)
+        return Branch(copy(self.condition), list(map(copy, self.true_instructions)), list(map(copy, self.false_instructions)))
 
     def verify(self):
         if not isinstance(State.scope, (Function, Module)):
@@ -1,10 +1,23 @@
+from .state import State
 from .core import Context, Object, BoundObject, Type
-from .function import FunctionType
+from .function import Function, FunctionType, Return
+from .links import Reference, Attribute
+from .literal import Literal
+from .comment import Comment
+from .variable import Variable, Assignment
+from .class_ import Constructor
+from .util import copy
 
 class Call(Object):
     called = None
     values = None
     function = None
+    # The literal the call evaluates to, if it is folded
+    constant = None
+    # The expression the call is replaced with, if it is inlined
+    inlined = None
+
+    verified = False
 
     def __init__(self, called:Object, values:[Object], tokens = None):
         super().__init__(tokens)
@@ -16,6 +29,29 @@ class Call(Object):
         return Call(copy(self.called), list(map(copy, self.values)))
 
     def verify(self):
+        if self.verified: return
+        self.verified = True
+
+        # Calls of attributes of the results of calls, such as long sums, are
+        # nested on the left. The innermost are verified first, so that
+        # verifying the chain doesn't recurse
+        nested = []
+        called = self.called
+        while isinstance(called, (Attribute, Call)):
+            if isinstance(called, Attribute):
+                called = called.value
+            elif not called.verified:
+                nested.append(called)
+                called = called.called
+            else:
+                break
+
+        for call in reversed(nested):
+            call.verified = True
+            call.verifyCall()
+        self.verifyCall()
+
+    def verifyCall(self):
         self.called.verify()
 
         # Verify arguments and create the function type of the call
@@ -23,13 +59,331 @@ class Call(Object):
         for val in self.values:
             val.verify()
             arg_types.append(val.resolveType())
-        call_type = FunctionType("", arg_types)
+        call_type = FunctionType("", arg_types, tokens=self.tokens)
 
         # Resolve the call
         self.function = self.called.resolveCall(call_type)
+        State.addDependency(self.function)
+
+        self.constant = foldCall(self)
+        State.calls.append(self)
+
+    # Inline the called function, if it is small enough. Should only be done
+    # once all functions are verified
+    def inline(self):
+        if self.constant is None:
+            self.inlined = Inliner(self).inline()
 
     def resolveType(self):
         return self.function.resolveType().return_type
 
     def __repr__(self):
         return "{}({})".format(self.called, ", ".join(repr(val) for val in self.values))
+
+#
+# Constant Folding
+#
+# Calls of the arithmetic and comparison operators of the builtin Int, Real
+# and Bool classes on constant operands are evaluated during verification. The
+# result is emitted as a literal in place of the call. Operations which are
+# undefined at run time, such as divisions by zero, are left as calls.
+
+INT_MIN = -2 ** 63
+
+# Wrap an integer to a signed 64 bit integer, as the builtin Int does
+def wrapInt(value:int) -> int:
+    return (value - INT_MIN) % 2 ** 64 + INT_MIN
+
+# Integer division rounds towards zero
+def divideInt(lhs:int, rhs:int) -> int:
+    if rhs == 0 or (lhs == INT_MIN and rhs == -1):
+        return None
+
+    quotient = abs(lhs) // abs(rhs)
+    return quotient if (lhs < 0) == (rhs < 0) else -quotient
+
+def divideReal(lhs:float, rhs:float) -> float:
+    if rhs == 0:
+        return None
+    return lhs / rhs
+
+# Operations by builtin class, operator and number of operands, including self.
+# Integer operands are wrapped first, as they are when emitted
+FOLDED_OPERATIONS = {
+    ("Int", "+", 1): lambda value: value,
+    ("Int", "-", 1): lambda value: wrapInt(-value),
+    ("Int", "+", 2): lambda lhs, rhs: wrapInt(lhs + rhs),
+    ("Int", "-", 2): lambda lhs, rhs: wrapInt(lhs - rhs),
+    ("Int", "*", 2): lambda lhs, rhs: wrapInt(lhs * rhs),
+    ("Int", "//", 2): divideInt,
+    ("Int", "==", 2): lambda lhs, rhs: lhs == rhs,
+    ("Int", "!=", 2): lambda lhs, rhs: lhs != rhs,
+    ("Int", ">", 2): lambda lhs, rhs: lhs > rhs,
+    ("Int", ">=", 2): lambda lhs, rhs: lhs >= rhs,
+    ("Int", "<", 2): lambda lhs, rhs: lhs < rhs,
+    ("Int", "<=", 2): lambda lhs, rhs: lhs <= rhs,
+    ("Real", "+", 2): lambda lhs, rhs: lhs + rhs,
+    ("Real", "-", 2): lambda lhs, rhs: lhs - rhs,
+    ("Real", "*", 2): lambda lhs, rhs: lhs * rhs,
+    ("Real", "/", 2): divideReal,
+    ("Bool", "!", 1): lambda value: not value,
+}
+
+# Returns the literal an object evaluates to, if it is constant
+def constantOf(object:Object) -> Literal:
+    if isinstance(object, Literal):
+        return object
+    elif isinstance(object, Call):
+        return object.constant
+    return None
+
+def tokenList(tokens) -> list:
+    if tokens is None:
+        return []
+    elif isinstance(tokens, list):
+        return tokens
+    return [tokens]
+
+# Returns the literal a verified call of a builtin operator evaluates to, or
+# None if it can't be folded
+def foldCall(call:Call) -> Literal:
+    if not isinstance(call.called, Attribute):
+        return None
+
+    operands = [constantOf(call.called.value)] + [constantOf(value) for value in call.values]
+    if any(operand is None for operand in operands):
+        return None
+
+    # Find the class of the operator, which must be a builtin
+    method = call.function.bound_context.scope if call.function.bound_context is not None else None
+    if method is None or method.bound_context is None:
+        return None
+    cls = method.bound_context.scope
+    if State.builtins.context.children.get(cls.name) is not cls:
+        return None
+
+    operation = FOLDED_OPERATIONS.get((cls.name, method.name, len(operands)))
+    if operation is None:
+        return None
+
+    data = [operand.data for operand in operands]
+    if cls.name == "Int":
+        data = list(map(wrapInt, data))
+    result = operation(*data)
+    if result is None:
+        return None
+
+    # The literal spans the whole operation
+    tokens = tokenList(operands[0].tokens)
+    if len(operands) > 1:
+        tokens = tokens + tokenList(call.tokens) + tokenList(operands[1].tokens)
+    else:
+        tokens = tokenList(call.tokens) + tokens
+
+    return Literal(result, call.resolveType(), tokens)
+
+#
+# Inlining
+#
+# Calls of small functions that only return an expression are replaced by a
+# copy of that expression. Arguments are substituted for the parameters they
+# are passed as, and the receiver of a method for self. So that arguments are
+# evaluated as often and in the same order as for a call, those which aren't
+# trivial must be used exactly once, in order, before anything is called.
+#
+# The returned expression may be preceded by assignments of trivial values to
+# locals, which are substituted for the locals. Functions which branch or loop
+# are never inlined, as an inlined expression is emitted within a single block
+# and lekvar has no conditional expressions to replace branches with.
+
+# The maximum number of objects in an inlined expression
+INLINE_COST = 16
+# The maximum depth of inlining within inlined expressions
+INLINE_DEPTH = 4
+
+# Returns whether evaluating an object has no effect, and always results in the
+# same value within an inlined expression of a function. Calls may change
+# globals and attributes, so only locals and arguments of functions other than
+# those the inlined function is nested in are trivial
+def isTrivial(object:Object, function:Function) -> bool:
+    if constantOf(object) is not None:
+        return True
+    if not isinstance(object, Reference) or not isinstance(object.value, Variable):
+        return False
+
+    variable = object.value
+    if variable.static or variable.bound_context is None:
+        return False
+    scope = variable.bound_context.scope
+    if not isinstance(scope, Function):
+        return False
+
+    while function is not None:
+        if function is scope:
+            return False
+        function = function.bound_context.scope if function.bound_context is not None else None
+    return True
+
+# Returns the assignments to locals of a function and the expression it then
+# returns, if it does nothing else
+def inlinedBody(function:Function) -> ([Assignment], Object):
+    if not isinstance(function, Function) or isinstance(function, Constructor):
+        return None
+    if not function.verified or function.dependent:
+        return None
+
+    instructions = [instruction for instruction in function.instructions
+                    if not isinstance(instruction, Comment)]
+    if len(instructions) == 0 or not isinstance(instructions[-1], Return):
+        return None
+
+    assignments = instructions[:-1]
+    for assignment in assignments:
+        if not isinstance(assignment, Assignment):
+            return None
+        variable = assignment.variable
+        if variable.bound_context is not function.local_context:
+            return None
+        if any(variable is argument for argument in function.arguments):
+            return None
+    return assignments, instructions[-1].value
+
+class Inliner:
+    function = None
+    # The objects substituted for self and the arguments
+    parameters = None
+    depth = 0
+    cost = 0
+    # The indices of non-trivial parameters in order of evaluation
+    evaluated = None
+    # Whether a non-trivial parameter is evaluated after a call
+    reordered = False
+    called = False
+    # The values substituted for locals, as pairs of local and value
+    locals = None
+
+    def __init__(self, call:Call, depth:int = 0):
+        self.function = call.function
+        self.depth = depth
+        self.evaluated = []
+        self.locals = []
+
+        # The receiver is only evaluated for calls of instance methods
+        receiver = None
+        if isinstance(call.called, Attribute) and not call.called.resolveValue().static:
+            receiver = call.called.value
+        self.parameters = [receiver] + list(call.values)
+
+    # Returns the inlined expression, or None if the call can't be inlined
+    def inline(self) -> Object:
+        body = inlinedBody(self.function)
+        if body is None:
+            return None
+        assignments, expression = body
+
+        for assignment in assignments:
+            # Locals are assigned once, to values which may be evaluated
+            # wherever they are used
+            if self.local(assignment.variable) is not None:
+                return None
+            value = self.substitute(assignment.value)
+            if value is None or not isTrivial(value, self.function):
+                return None
+            self.locals.append((assignment.variable, value))
+
+        inlined = self.substitute(expression)
+        if inlined is None or self.reordered:
+            return None
+
+        expected = [index for index, parameter in enumerate(self.parameters)
+                    if parameter is not None and not isTrivial(parameter, self.function)]
+        if self.evaluated != expected:
+            return None
+        return inlined
+
+    # Returns a copy of an object of the function with parameters substituted,
+    # or None if it can't be copied. Unchanged objects are shared
+    def substitute(self, object:Object) -> Object:
+        self.cost += 1
+        if self.cost > INLINE_COST:
+            return None
+
+        if isinstance(object, (Literal, Comment)):
+            return object
+        elif isinstance(object, Reference):
+            return self.substituteReference(object)
+        elif isinstance(object, Attribute):
+            value = self.substitute(object.value)
+
+            # Values of static attributes are never evaluated
+            if object.attribute.static:
+                return object if value is object.value else None
+            if value is None:
+                return None
+            return verifiedAttribute(value, object.attribute, object.tokens)
+        elif isinstance(object, Call):
+            called = self.substitute(object.called)
+            values = [self.substitute(value) for value in object.values]
+            if called is None or any(value is None for value in values):
+                return None
+
+            if called is object.called and all(new is old for new, old in zip(values, object.values)):
+                call = object
+            else:
+                call = Call(called, values, object.tokens)
+                call.function = object.function
+                call.constant = foldCall(call)
+                if call.constant is None and self.depth < INLINE_DEPTH:
+                    call.inlined = Inliner(call, self.depth + 1).inline()
+
+            self.called = self.called or call.constant is None
+            return call
+        return None
+
+    def substituteReference(self, reference:Reference) -> Object:
+        value = reference.value
+
+        local = self.local(value)
+        if local is not None:
+            return local
+
+        for index, argument in enumerate(self.function.arguments):
+            if value is argument:
+                return self.parameter(index + 1)
+
+        if isinstance(value, Variable) and value.bound_context is self.function.closed_context:
+            return self.parameter(0)
+
+        # Attributes of self
+        method = self.function.bound_context.scope if self.function.bound_context is not None else None
+        cls = method.bound_context.scope if method is not None and method.bound_context is not None else None
+        if isinstance(value, Variable) and not value.static and value.bound_context is not None and value.bound_context.scope is cls:
+            receiver = self.parameter(0)
+            if receiver is None:
+                return None
+            return verifiedAttribute(receiver, value, reference.tokens)
+
+        if value.static:
+            return reference
+        return None
+
+    # Returns the value substituted for a local, if it is assigned
+    def local(self, variable:Variable) -> Object:
+        for local, value in self.locals:
+            if local is variable:
+                return value
+        return None
+
+    def parameter(self, index:int) -> Object:
+        parameter = self.parameters[index]
+        if parameter is not None and not isTrivial(parameter, self.function):
+            self.evaluated.append(index)
+            self.reordered = self.reordered or self.called
+        return parameter
+
+# Returns an attribute of a value, resolved to a known attribute
+def verifiedAttribute(value:Object, attribute:BoundObject, tokens) -> Attribute:
+    object = Attribute(value, attribute.name, tokens)
+    object.attribute = attribute
+    object.verified = True
+    return object
@@ -5,6 +5,7 @@ from .core import Context, Object, BoundObject, Type
 from .function import Function, FunctionType, Return
 from .method import Method, MethodType
 from .variable import Variable
+from .util import copy
 
 class Class(Type):
     constructor = None
@@ -44,7 +45,15 @@ class Class(Type):
             if self.constructor is not None:
                 self.constructor.verify()
 
-        self.instance_context.verify()
+        # Methods of lazy classes are verified once they are resolved, but
+        # attributes are needed for the layout of the class
+        if State.isLazy(self):
+            with State.scoped(self):
+                for child in self.instance_context:
+                    if not isinstance(child, Method):
+                        child.verify()
+        else:
+            self.instance_context.verify()
 
     def resolveType(self):
         raise InternalError("Not Implemented")
@@ -61,6 +70,9 @@ class Class(Type):
     def checkCompatibility(self, other:Type) -> bool:
         return other.resolveValue() is self
 
+    def resolveDispatchKey(self):
+        return self
+
     def __repr__(self):
         contents = "\n".join(repr(val) for val in [self.constructor] + list(self.instance_context))
         return "class {}\n{}\nend".format(self.name, contents)
@@ -71,7 +83,9 @@ class Constructor(Function):
             raise TypeError("Constructors must return nothing", function.tokens)
         function.type.return_type = constructing
 
-        super().__init__(function.name, function.arguments, function.instructions, function.type.return_type, tokens)
+        # Keep lazily loaded instructions lazy
+        instructions = function.load_instructions or function.instructions
+        super().__init__(function.name, function.arguments, instructions, function.type.return_type, tokens)
 
     def verifySelf(self):
         for instruction in self.instructions:
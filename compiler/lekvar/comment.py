@@ -7,8 +7,9 @@ class Comment(Object):
         super().__init__(tokens)
         self.contents = contents
 
+    # Comments are immutable, so they are shared
     def copy(self):
-        return Comment(self.contents)
+        return self
 
     def verify(self):
         pass
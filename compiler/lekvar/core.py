@@ -26,15 +26,16 @@ class Context:
         for child in children:
             self.addChild(child)
 
-    # Verifies all child objects within the scope of this context's scope
+    # Schedules all child objects for verification within the scope of this
+    # context's scope
     def verify(self):
-        with State.scoped(self.scope):
-            for child in self.children.values():
-                child.verify()
+        for child in self.children.values():
+            State.schedule(child, self.scope)
 
     # Doubly link a child to the context
     def addChild(self, child):
         self.children[child.name] = child
+        State.invalidateSymbol(child.name)
         self.fakeChild(child)
 
     # Bind the child to the context, but not the context to the child
@@ -50,6 +51,7 @@ class Context:
 
     def __setitem__(self, name:str, value:BoundObject):
         self.children[name] = value
+        State.invalidateSymbol(name)
 
     # Iterate through the children (not their names)
     def __iter__(self):
@@ -68,7 +70,8 @@ class Object(ABC):
     def __init__(self, tokens = None):
         self.tokens = tokens
 
-    # Should return a unverified deep copy of the object
+    # Should return a unverified deep copy of the object. Subtrees that are
+    # verified and resolve identically in every copy may be shared instead
     @abstract
     def copy(self):
         pass
@@ -140,3 +143,8 @@ class Type(BoundObject):
     @abstract
     def checkCompatibility(self, other:Type) -> bool:
         pass
+
+    # Returns a hashable key, such that types are compatible exactly when their
+    # keys are equal. Returns None if compatibility can't be decided by keys
+    def resolveDispatchKey(self):
+        return None
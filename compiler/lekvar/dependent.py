@@ -34,6 +34,28 @@ class DependentType(Type):
     def resolveType(self):
         raise InternalError("Not Implemented")
 
+    def resolveDispatchKey(self):
+        if self.target is not None:
+            return self.target.resolveDispatchKey()
+        return None
+
+    # Targeted dependent types stand in for their target
+    def resolveValue(self):
+        if self.target is not None:
+            return self.target.resolveValue()
+        return self
+
+    @property
+    def local_context(self):
+        return None
+
+    # Instances of targeted dependent types have the attributes of the target
+    @property
+    def instance_context(self):
+        if self.target is not None:
+            return self.target.instance_context
+        return None
+
     def __repr__(self):
         if self.target is None:
             return "{}<{}>".format(self.__class__.__name__, self.compatibles)
@@ -1,27 +1,44 @@
+from collections import OrderedDict
+
 from ..errors import *
 
 from .state import State
 from .core import Context, Object, BoundObject, Type
-from .util import checkCompatibility
+from .util import checkCompatibility, copy
 from .variable import Variable
 from .dependent import DependentType
 
 # Python Predefines
 FunctionType = None
 
+# The maximum number of template instances kept per dependent function
+INSTANCE_CACHE_SIZE = 64
 
 class Function(BoundObject):
     _local_context = None
     closed_context = None
 
     arguments = None
-    instructions = None
+    _instructions = None
+    # Produces the instructions when they are first needed, if they were
+    # not given up front
+    load_instructions = None
 
     type = None
+    # The return type given to the function, before any inference
+    declared_return_type = None
     dependent = False
     verified = False
     static = False
 
+    # Template instances of a dependent function, by argument types, in least
+    # recently used order
+    instances = None
+    instance_hits = 0
+    instance_misses = 0
+
+    # instructions may also be a function returning the instructions, which
+    # is called when they are first needed
     def __init__(self, name:str, arguments:[Variable], instructions:[Object], return_type:Type = None, tokens = None):
         super().__init__(name, tokens)
 
@@ -29,21 +46,37 @@ class Function(BoundObject):
         self.closed_context = Context(self, [])
 
         self.arguments = arguments
-        self.instructions = instructions
+        if callable(instructions):
+            self.load_instructions = instructions
+        else:
+            self._instructions = instructions
 
         for arg in self.arguments:
             if arg.type is None:
                 arg.type = DependentType()
                 self.dependent = True
 
+        self.declared_return_type = return_type
         self.type = FunctionType(name, [arg.type for arg in arguments], return_type)
 
+    @property
+    def instructions(self):
+        if self.load_instructions is not None:
+            self._instructions = self.load_instructions()
+            self.load_instructions = None
+        return self._instructions
+
+    @instructions.setter
+    def instructions(self, instructions:[Object]):
+        self._instructions = instructions
+        self.load_instructions = None
+
     @property
     def local_context(self):
         return self._local_context
 
     def copy(self):
-        fn = Function(self.name, list(map(copy, self.arguments)), list(map(copy, self.instructions)), self.type.return_type)
+        fn = Function(self.name, list(map(copy, self.arguments)), list(map(copy, self.instructions)), copy(self.declared_return_type))
         fn.static = self.static
         return fn
 
@@ -68,6 +101,20 @@ class Function(BoundObject):
     def resolveType(self):
         return self.type
 
+    # Whether any return of the function returns a value, including those
+    # nested in branches and loops
+    def returnsValue(self) -> bool:
+        stack = list(self.instructions)
+        while stack:
+            instruction = stack.pop()
+            if isinstance(instruction, Return):
+                if instruction.value is not None:
+                    return True
+            elif not isinstance(instruction, Function):
+                for name in ("instructions", "true_instructions", "false_instructions"):
+                    stack.extend(getattr(instruction, name, None) or [])
+        return False
+
     def resolveCall(self, call:FunctionType):
         if not checkCompatibility(self.resolveType(), call):
             raise TypeError("Function is not callable with {}".format(call), self.tokens)
@@ -75,11 +122,30 @@ class Function(BoundObject):
         if not self.dependent:
             return self
 
-        # Create a template instance
+        # Reuse the template instance for identical argument types
+        key = tuple(type.resolveValue() for type in call.arguments)
+        if self.instances is None:
+            self.instances = OrderedDict()
+        elif key in self.instances:
+            self.instance_hits += 1
+            self.instances.move_to_end(key)
+            return self.instances[key]
+        self.instance_misses += 1
+
+        # Create a template instance, in the scope of the template
         fn = copy(self)
+        fn.name = "{}.{}".format(self.name, self.instance_misses)
+        if self.bound_context is not None:
+            self.bound_context.fakeChild(fn)
         for index, arg in enumerate(fn.arguments):
             if isinstance(arg.type, DependentType):
                 fn.type.arguments[index] = arg.type.target = call.arguments[index]
+
+        # Cache the instance before verifying it, for recursive calls
+        self.instances[key] = fn
+        if len(self.instances) > INSTANCE_CACHE_SIZE:
+            self.instances.popitem(last=False)
+
         fn.verify()
         return fn
 
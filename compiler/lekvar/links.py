@@ -1,7 +1,8 @@
 from ..errors import *
 
+from .state import State
 from .core import Context, Object, BoundObject, Type
-from .util import resolveReference, resolveAttribute
+from .util import resolveReference, resolveAttribute, copy
 from .function import Function, FunctionType
 
 class Reference(Type):
@@ -14,7 +15,11 @@ class Reference(Type):
         super().__init__(reference, tokens)
         self.reference = reference
 
+    # References resolved to static objects resolve identically in every copy,
+    # so they are shared
     def copy(self):
+        if self.verified and self.value is not None and self.value.static:
+            return self
         return Reference(self.reference)
 
     def verify(self):
@@ -27,6 +32,7 @@ class Reference(Type):
         except MissingReferenceError as e:
             e.addMessage("", self.tokens)
             raise e
+        State.addDependency(self.value, self.reference)
         self.value.verify()
 
     def resolveType(self):
@@ -53,6 +59,11 @@ class Reference(Type):
     def checkCompatibility(self, other:Type):
         return self.value.checkCompatibility(other)
 
+    def resolveDispatchKey(self):
+        if self.value is None:
+            return None
+        return self.value.resolveDispatchKey()
+
     def __repr__(self):
         return "{}".format(self.reference)
 
@@ -68,8 +79,12 @@ class Attribute(Type):
         self.value = value
         self.reference = reference
 
+    # Attributes of shared values resolved to static attributes are shared
     def copy(self):
-        return Attribute(self.value, self.reference)
+        value = copy(self.value)
+        if value is self.value and self.attribute is not None and self.attribute.static:
+            return self
+        return Attribute(value, self.reference)
 
     def verify(self):
         if self.verified: return
@@ -78,11 +93,13 @@ class Attribute(Type):
         self.value.verify()
         # Resolve the attribute using the values attribute resolution
         self.attribute = resolveAttribute(self.value, self.reference)
-        self.attribute.verify()
 
         if self.attribute is None:
             raise MissingReferenceError("{} does not have an attribute {}".format(self.value, self.reference), self.value.tokens + self.tokens)
 
+        State.addDependency(self.attribute)
+        self.attribute.verify()
+
     @property
     def local_context(self):
         return self.attribute.local_context
@@ -107,5 +124,10 @@ class Attribute(Type):
     def checkCompatibility(self, other:Type):
         return self.attribute.checkCompatibility(other)
 
+    def resolveDispatchKey(self):
+        if self.attribute is None:
+            return None
+        return self.attribute.resolveDispatchKey()
+
     def __repr__(self):
         return "{}.{}".format(self.value, self.reference)
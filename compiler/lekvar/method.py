@@ -1,6 +1,9 @@
+from ..errors import SemanticError
+
 from .state import State
 from .core import Context, Object, BoundObject, Type
 from .function import Function, FunctionType
+from .util import copy, resolveDispatchKeys
 
 # Python Predefines
 Method = None
@@ -9,6 +12,8 @@ class Method(BoundObject):
     overload_context = None
     verified = False
     type = None
+    # Built once the method is verified
+    dispatch = None
 
     def __init__(self, name:str, overloads:[Function], tokens = None):
         super().__init__(name, tokens)
@@ -23,6 +28,7 @@ class Method(BoundObject):
     def addOverload(self, overload:Function):
         overload.name = str(len(self.overload_context.children))
         self.overload_context.addChild(overload)
+        self.dispatch = None
 
     def assimilate(self, other:Method):
         for overload in other.overload_context:
@@ -33,8 +39,16 @@ class Method(BoundObject):
         self.verified = True
 
         with State.scoped(self):
+            # Overload resolution only needs the types of overloads. Their
+            # bodies are verified later, or once they are resolved if lazy
             for overload in self.overload_context:
-                overload.verify()
+                with State.scoped(overload):
+                    overload.resolveType().verify()
+
+                if not State.isLazy(self):
+                    State.schedule(overload, self)
+
+        self.dispatch = DispatchIndex(list(self.overload_context))
 
     def resolveType(self):
         if self.type is None:
@@ -42,12 +56,13 @@ class Method(BoundObject):
         return self.type
 
     def resolveCall(self, call:FunctionType):
-        matches = []
-
-        # Collect overloads which match the call type
-        for overload in self.overload_context:
-            if overload.resolveType().checkCompatibility(call):
-                matches.append(overload)
+        # Collect overloads which match the call type. Calls made while the
+        # method is still being verified check every overload
+        if self.dispatch is not None:
+            matches = self.dispatch.resolve(call)
+        else:
+            matches = [overload for overload in self.overload_context
+                       if overload.resolveType().checkCompatibility(call)]
 
         # Allow only one match
         if len(matches) < 1:
@@ -59,7 +74,26 @@ class Method(BoundObject):
                 (("", match.tokens) for match in matches)
             )
 
-        return matches[0]
+        match = matches[0]
+
+        # The body of the match is only needed right away to infer its return
+        # type
+        if match.resolveType().return_type is None:
+            match.verify()
+
+            # A function whose return type is still unknown is being verified,
+            # and the call cycles back to it before any of its returns
+            if (isinstance(match, Function) and match.resolveType().return_type is None
+                    and match.returnsValue()):
+                raise SemanticError("Recursive calls of {} need a declared return type".format(self.name), call.tokens)
+        else:
+            State.schedule(match, self)
+
+        # Dependent overloads are instantiated for the call, unless the call is
+        # itself within a template
+        if match.dependent and not State.scope.dependent:
+            return match.resolveCall(call)
+        return match
 
     @property
     def local_context(self):
@@ -68,6 +102,63 @@ class Method(BoundObject):
     def __repr__(self):
         return "method {}".format(self.name)
 
+#
+# Dispatch Index
+#
+# Buckets the overloads of a method by arity and the dispatch keys of their
+# argument types, so that a call only needs to look up its own keys. Overloads
+# with argument types that have no dispatch key (such as dependent types) are
+# checked for compatibility as usual. The matches of each call type are cached.
+
+class DispatchIndex:
+    overloads = None
+    # Indices of overloads by arity and dispatch keys
+    buckets = None
+    # Indices of overloads by arity, for those without dispatch keys
+    generic = None
+    # Indices of all overloads by arity
+    arities = None
+    cache = None
+
+    def __init__(self, overloads:[Function]):
+        self.overloads = overloads
+        self.buckets = {}
+        self.generic = {}
+        self.arities = {}
+        self.cache = {}
+
+        for index, overload in enumerate(overloads):
+            arguments = overload.resolveType().arguments
+            self.arities.setdefault(len(arguments), []).append(index)
+
+            keys = resolveDispatchKeys(arguments)
+            if keys is None:
+                self.generic.setdefault(len(arguments), []).append(index)
+            else:
+                self.buckets.setdefault(len(arguments), {}).setdefault(keys, []).append(index)
+
+    # Returns the overloads matching a call type, in order of definition
+    def resolve(self, call:FunctionType) -> [Function]:
+        keys = resolveDispatchKeys(call.arguments)
+        if keys is not None and keys in self.cache:
+            return self.cache[keys]
+
+        arity = len(call.arguments)
+        if keys is None:
+            candidates = self.arities.get(arity, [])
+            indices = []
+        else:
+            candidates = self.generic.get(arity, [])
+            indices = self.buckets.get(arity, {}).get(keys, [])
+
+        indices = sorted(indices + [index for index in candidates
+            if self.overloads[index].resolveType().checkCompatibility(call)])
+        matches = [self.overloads[index] for index in indices]
+
+        if keys is not None:
+            self.cache[keys] = matches
+        return matches
+
 class MethodType(Type):
     overloads = None
 
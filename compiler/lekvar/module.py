@@ -10,6 +10,11 @@ class Module(BoundObject):
     static = True
     type = None
 
+    # Fingerprints of the source of each definition, by name, if known
+    fingerprints = None
+    # The names each definition depends on, by name, once verified
+    dependencies = None
+
     def __init__(self, name:str, children:[BoundObject], main:[Object] = [], tokens = None):
         super().__init__(name, tokens)
 
@@ -31,7 +36,19 @@ class Module(BoundObject):
         with State.scoped(self):
             for instruction in self.main:
                 instruction.verify()
-        self.context.verify()
+
+        # Lazy children are verified once they are resolved
+        if State.isLazy(self): return
+
+        # Unless building a library, so are other definitions, so that those
+        # unreachable from main instructions are never verified. The main
+        # instructions of child modules always run, so those are verified
+        if State.library:
+            self.context.verify()
+        else:
+            for child in self.context:
+                if isinstance(child, Module):
+                    State.schedule(child, self)
 
     def resolveType(self):
         if self.type is not None:
@@ -1,8 +1,11 @@
 import logging
+from collections import deque
 from contextlib import contextmanager
+from contextvars import ContextVar
 
 # Python predefines
 Module = None
+Object = None
 BoundObject = None
 
 # classproperty, because classmethod and property don't combine
@@ -13,17 +16,135 @@ class classproperty:
     def __get__(self, _, owner):
         return self.getter(owner)
 
-# The global state for the verifier
-class State:
+# The state of a single verification
+class VerifierState:
+    module = None
     builtins = None
     logger = None
     scope_stack = None
+    # Whether builtins are verified on demand, as they are resolved
+    lazy = False
+    # The symbol table, mapping names to scopes to the objects the name
+    # resolves to from that scope
+    symbols = None
+    # Objects waiting to be verified, with the scope to verify them in
+    worklist = None
+    # The names each definition of the module depends on, by its name
+    dependencies = None
+    # Whether definitions of the module which are unreachable from its main
+    # instructions are still verified, as for libraries
+    library = False
+    # Verified calls, to be inlined once verification is done
+    calls = None
+
+    def __init__(self, module:Module, builtins:Module, logger:logging.Logger, lazy:bool = False, library:bool = False):
+        self.module = module
+        self.builtins = builtins
+        self.logger = logger
+        self.scope_stack = []
+        self.lazy = lazy
+        self.symbols = {}
+        self.worklist = deque()
+        self.dependencies = {}
+        self.library = library
+        self.calls = []
+
+    # Returns the definition of the module which contains an object, or None
+    def definitionOf(self, object:BoundObject) -> BoundObject:
+        while object is not None and object.bound_context is not None:
+            if object.bound_context.scope is self.module:
+                return object
+            object = object.bound_context.scope
+        return None
+
+# The state of the current verification. Being a context variable, every
+# thread and task has its own, so that verifications may run concurrently
+_current = ContextVar("lekvar.State", default=None)
+
+def stateProperty(name:str):
+    return classproperty(lambda cls: getattr(_current.get(), name, None))
+
+# The interface to the state of the current verification
+class State:
+    module = stateProperty("module")
+    builtins = stateProperty("builtins")
+    logger = stateProperty("logger")
+    scope_stack = stateProperty("scope_stack")
+    lazy = stateProperty("lazy")
+    symbols = stateProperty("symbols")
+    worklist = stateProperty("worklist")
+    dependencies = stateProperty("dependencies")
+    library = stateProperty("library")
+    calls = stateProperty("calls")
+
+    @classproperty
+    def current(cls) -> VerifierState:
+        return _current.get()
+
+    # Verify within a new state, restoring the previous state afterwards
+    @classmethod
+    @contextmanager
+    def begin(cls, module:Module, builtins:Module, logger:logging.Logger, lazy:bool = False, library:bool = False):
+        token = _current.set(VerifierState(module, builtins, logger, lazy, library))
+        try:
+            yield
+        finally:
+            _current.reset(token)
+
+    # Verify an object once the objects scheduled before it are verified,
+    # within a given scope. Objects which are needed right away, such as
+    # functions whose return type is inferred, are still verified on demand,
+    # and are skipped by the worklist through their verified flag
+    @classmethod
+    def schedule(cls, object:Object, scope:BoundObject):
+        cls.worklist.append((scope, object))
+
+    # Verify scheduled objects until none are left. As every object schedules
+    # the definitions within it rather than verifying them, the depth of
+    # verification is bounded by the nesting within a single definition
+    @classmethod
+    def verifyScheduled(cls):
+        worklist = cls.worklist
+        while worklist:
+            scope, object = worklist.popleft()
+            with cls.scoped(scope):
+                object.verify()
+
+    # Record that the definition being verified depends on an object, and on
+    # the name it was looked up by, if any. Definitions are only recorded
+    # within the module being verified
+    @classmethod
+    def addDependency(cls, object:BoundObject, name:str = None):
+        state = cls.current
+        dependent = state.definitionOf(cls.scope)
+        if dependent is None: return
+
+        names = state.dependencies.setdefault(dependent.name, set())
+        if name is not None:
+            names.add(name)
+
+        definition = state.definitionOf(object)
+        if definition is not None and definition is not dependent:
+            names.add(definition.name)
 
+    # Forget all resolutions of a name, for when an object of that name is
+    # added to a context
     @classmethod
-    def init(cls, builtins:Module, logger:logging.Logger):
-        cls.builtins = builtins
-        cls.logger = logger
-        cls.scope_stack = []
+    def invalidateSymbol(cls, name:str):
+        if cls.symbols is not None:
+            cls.symbols.pop(name, None)
+
+    # Returns whether an object should only be verified once it is used
+    @classmethod
+    def isLazy(cls, object:BoundObject) -> bool:
+        if not cls.lazy: return False
+
+        # Only builtins are verified lazily
+        while object is not None:
+            if object is cls.builtins:
+                return True
+            object = object.bound_context.scope if (object.bound_context is not None) else None
+        return False
 
     @classproperty
     def scope(cls):
@@ -16,17 +16,20 @@ def checkCompatibility(type1:Type, type2:Type):
         return True
     return False
 
-# Resolves a reference inside of a given scope.
-def resolveReference(reference:str):
-    # Collect all objects with a name matching reference up the tree of scopes
-    found = []
+# Collect all objects with a name matching reference up the tree of scopes,
+# starting at a given scope. Results are memoized for every scope on the way
+# in the symbol table, so that they can be reused by nested scopes.
+def collectReferences(scope:BoundObject, reference:str) -> tuple:
+    table = State.symbols.setdefault(reference, {})
 
-    scope = State.scope
+    # Move up the tree until a scope with a known result is found
+    path = []
+    found = ()
     while True:
-        context = scope.local_context
-
-        if context is not None and reference in context:
-            found.append(context[reference])
+        if scope in table:
+            found = table[scope]
+            break
+        path.append(scope)
 
         # Go to builtins once the top of the tree is reached, otherwise move up
         if scope is State.builtins:
@@ -34,6 +37,31 @@ def resolveReference(reference:str):
         else:
             scope = scope.bound_context.scope if (scope.bound_context is not None) else State.builtins
 
+    # Fill in the results on the way back down
+    for scope in reversed(path):
+        context = scope.local_context
+
+        if context is not None and reference in context:
+            found = (context[reference],) + found
+        table[scope] = found
+
+    return found
+
+# Returns the dispatch keys of a list of types, or None if any type does not
+# have a dispatch key
+def resolveDispatchKeys(types:[Type]):
+    keys = []
+    for type in types:
+        key = type.resolveDispatchKey() if type is not None else None
+        if key is None:
+            return None
+        keys.append(key)
+    return tuple(keys)
+
+# Resolves a reference inside of a given scope.
+def resolveReference(reference:str):
+    found = collectReferences(State.scope, reference)
+
     # Only a single found object is valid
     if len(found) < 1:
         raise MissingReferenceError("No reference to {}".format(reference))
@@ -1,6 +1,7 @@
 from ctypes import *
 import traceback
 import logging
+from contextvars import ContextVar
 
 from ..errors import *
 
@@ -11,8 +12,9 @@ c_bool = c_int
 class NullException(Exception):
     pass
 
-class State:
-    logger = None
+# The logger calls are logged to. Being a context variable, every emission
+# sets its own
+logger = ContextVar("llvm.bindings.logger", default=None)
 
 #
 # Wrapping tools
@@ -53,11 +55,12 @@ def logged(cls_name, name, check_null = True):
     def logged(func):
         def f(self, *args):
             # Log the call, if possible
-            if State.logger:
+            call_logger = logger.get()
+            if call_logger:
                 if isinstance(self, type):
-                    State.logger.debug("{}.{} calling {}{}".format(self.__name__, cls_name, name, args), stack_info=True)
+                    call_logger.debug("{}.{} calling {}{}".format(self.__name__, cls_name, name, args), stack_info=True)
                 else:
-                    State.logger.debug("{}.{} calling {}{}".format(self.__class__.__name__, cls_name, name, tuple([self] + list(args))), stack_info=True)
+                    call_logger.debug("{}.{} calling {}{}".format(self.__class__.__name__, cls_name, name, tuple([self] + list(args))), stack_info=True)
 
             # Perform the call
             ret = func(self, *args)
@@ -197,6 +200,18 @@ Context.wrapConstructor("new", "LLVMContextCreate")
 Context.wrapConstructor("getGlobal", "LLVMGetGlobalContext")
 Context.wrapDestructor("LLVMContextDispose")
 
+# Types, constants and blocks within the context. The constructors of the other
+# classes use the global context
+Context.wrapInstanceFunc("voidType", "LLVMVoidTypeInContext", [], Type)
+Context.wrapInstanceFunc("intType", "LLVMIntTypeInContext", [c_uint], Int)
+Context.wrapInstanceFunc("halfType", "LLVMHalfTypeInContext", [], Float)
+Context.wrapInstanceFunc("floatType", "LLVMFloatTypeInContext", [], Float)
+Context.wrapInstanceFunc("doubleType", "LLVMDoubleTypeInContext", [], Float)
+Context.wrapInstanceFunc("structType", "LLVMStructTypeInContext", [[Type], c_bool], Struct)
+Context.wrapInstanceFunc("constStruct", "LLVMConstStructInContext", [[Value], c_bool], Value)
+Context.wrapInstanceFunc("appendBlock", "LLVMAppendBasicBlockInContext", [FunctionValue, c_char_p], Block)
+Context.wrapInstanceFunc("insertBlock", "LLVMInsertBasicBlockInContext", [Block, c_char_p], Block)
+
 #
 # Module
 #
@@ -235,10 +250,10 @@ def Module_verify(self):
     disposeError(error_msg)
 
     if result == 1: # 1 means success with some errors
-        State.logger.warn(message)
+        logger.get().warn(message)
         return
     # Otherwise it should be failure
-    State.logger.error(message)
+    logger.get().error(message)
     raise InternalError("LLVM: Module verification exit code {}".format(result))
 Module.verify = Module_verify
 
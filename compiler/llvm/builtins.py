@@ -4,12 +4,7 @@ from .emitter import *
 from .. import lekvar
 from . import bindings as llvm
 
-printf = None
-
 def builtins():
-    global printf
-    printf = None
-
     string = LLVMType("String")
     ints = [
         LLVMType("Int8"),
@@ -28,21 +23,23 @@ def builtins():
     builtin_objects = [string, bool] + ints + floats
 
     # (the types the method applies to, the name, the instruction, additional arguments)
+    # Instructions are named by their Builder method, so that builtins can be
+    # pickled
     methods = [
-        (ints, "intAdd", llvm.Builder.iAdd, []),
-        (ints, "intSub", llvm.Builder.iSub, []),
-        (ints, "intMul", llvm.Builder.iMul, []),
-        (ints, "intDiv", llvm.Builder.siDiv, []),
-        (ints, "intEqual", llvm.Builder.iCmp, [llvm.IntPredicate.equal]),
-        (ints, "intUnequal", llvm.Builder.iCmp, [llvm.IntPredicate.unequal]),
-        (ints, "intGreaterThan", llvm.Builder.iCmp, [llvm.IntPredicate.signed_greater_than]),
-        (ints, "intGreaterOrEqualTo", llvm.Builder.iCmp, [llvm.IntPredicate.signed_greater_or_equal_to]),
-        (ints, "intSmallerThan", llvm.Builder.iCmp, [llvm.IntPredicate.signed_less_than]),
-        (ints, "intSmallerOrEqualTo", llvm.Builder.iCmp, [llvm.IntPredicate.signed_less_or_equal_to]),
-        (floats, "floatAdd", llvm.Builder.fAdd, []),
-        (floats, "floatSub", llvm.Builder.fSub, []),
-        (floats, "floatMul", llvm.Builder.fMul, []),
-        (floats, "floatDiv", llvm.Builder.fDiv, []),
+        (ints, "intAdd", "iAdd", []),
+        (ints, "intSub", "iSub", []),
+        (ints, "intMul", "iMul", []),
+        (ints, "intDiv", "siDiv", []),
+        (ints, "intEqual", "iCmp", [llvm.IntPredicate.equal]),
+        (ints, "intUnequal", "iCmp", [llvm.IntPredicate.unequal]),
+        (ints, "intGreaterThan", "iCmp", [llvm.IntPredicate.signed_greater_than]),
+        (ints, "intGreaterOrEqualTo", "iCmp", [llvm.IntPredicate.signed_greater_or_equal_to]),
+        (ints, "intSmallerThan", "iCmp", [llvm.IntPredicate.signed_less_than]),
+        (ints, "intSmallerOrEqualTo", "iCmp", [llvm.IntPredicate.signed_less_or_equal_to]),
+        (floats, "floatAdd", "fAdd", []),
+        (floats, "floatSub", "fSub", []),
+        (floats, "floatMul", "fMul", []),
+        (floats, "floatDiv", "fDiv", []),
     ]
 
     for types, name, instruction, arguments in methods:
@@ -54,7 +51,9 @@ def builtins():
             functions.append(
                 LLVMFunction("", [type, type], return_type,
                     partial(llvmInstructionWrapper, instruction,
-                            additional_arguments=arguments)
+                            additional_arguments=arguments),
+                    partial(llvmInstruction, instruction,
+                            additional_arguments=arguments),
                 )
             )
         builtin_objects.append(
@@ -70,19 +69,22 @@ def builtins():
 
     return lekvar.Module("_builtins", builtin_objects)
 
-def llvmInstructionWrapper(instruction, self, additional_arguments = []):
+def llvmInstructionWrapper(instruction:str, self, additional_arguments = []):
     name = resolveName(self)
     func_type = self.type.emitType()
     self.llvm_value = State.module.addFunction(name, func_type)
-    entry = self.llvm_value.appendBlock("")
+    entry = State.context.appendBlock(self.llvm_value, "")
 
     with State.blockScope(entry):
         lhs = self.llvm_value.getParam(0)
         rhs = self.llvm_value.getParam(1)
-        arguments = [State.builder] + additional_arguments + [lhs, rhs, ""]
-        return_value = instruction(*arguments)
+        return_value = llvmInstruction(instruction, [lhs, rhs], additional_arguments)
         State.builder.ret(return_value)
 
+def llvmInstruction(instruction:str, arguments:[llvm.Value], additional_arguments = []):
+    arguments = additional_arguments + arguments + [State.getTempName()]
+    return getattr(State.builder, instruction)(*arguments)
+
 PRINTF_MAP = {
     "String": "s",
 
@@ -98,16 +100,16 @@ PRINTF_MAP = {
 }
 
 def llvmPrintfWrapper(type, self):
-    global printf
-    func_type = llvm.Function.new(llvm.Type.void(), [LLVMType("String").emitType()], True)
+    func_type = llvm.Function.new(State.context.voidType(), [LLVMType("String").emitType()], True)
 
-    if printf is None:
-        printf = State.module.addFunction("printf", func_type)
+    if State.current.printf is None:
+        State.current.printf = State.module.addFunction("printf", func_type)
+    printf = State.current.printf
 
     name = resolveName(self)
     func_type = self.type.emitType()
     self.llvm_value = State.module.addFunction(name, func_type)
-    entry = self.llvm_value.appendBlock("")
+    entry = State.context.appendBlock(self.llvm_value, "")
 
     with State.blockScope(entry):
         fmt_str_data = "%{}\n".format(PRINTF_MAP[type.name])
@@ -146,15 +148,22 @@ class LLVMType(lekvar.Type):
                 return True
         return False
 
+    def resolveDispatchKey(self):
+        return (LLVMType, self.name)
+
     def __repr__(self):
         return "{}<{}>".format(self.__class__.__name__, self.name)
 
 class LLVMFunction(lekvar.ExternalFunction):
     generator = None
+    # Emits the function in place of a call, given the values of the
+    # arguments, if set
+    inline_generator = None
 
-    def __init__(self, name:str, arguments:[lekvar.Type], return_type:lekvar.Type, generator):
+    def __init__(self, name:str, arguments:[lekvar.Type], return_type:lekvar.Type, generator, inline_generator = None):
         super().__init__(name, name, arguments, return_type)
         self.generator = generator
+        self.inline_generator = inline_generator
 
     @property
     def local_context(self):
@@ -2,53 +2,114 @@ import os
 import logging
 import tempfile
 from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import partial
 from abc import abstractmethod as abstract
 from subprocess import check_output
 
 from .. import lekvar
+from ..lekvar.state import classproperty
 from ..errors import *
 
 from . import bindings as llvm
 
 def emit(module:lekvar.Module, logger = logging.getLogger()):
-    State.logger = logger.getChild("llvm")
-    llvm.State.logger = State.logger.getChild("bindings")
+    logger = logger.getChild("llvm")
 
-    with State.begin("main", logger):
+    with State.begin("main", logger) as state:
         module.emit()
 
-    State.module.verify()
-
-    return State.module.toString()
+    return state.module.toString()
 
 def run(source:bytes):
     return check_output("lli", input = source)
 
+# The state of a single emission
+class EmitterState:
+    logger = None
+    self = None
+    # The LLVM context of the emission. Every emission has its own, as LLVM
+    # contexts may not be used by more than one thread at a time
+    context = None
+    builder = None
+    module = None
+    main = None
+    # The printf function of the module, once it is used
+    printf = None
+    # The LLVM values of objects in the module, by object and attribute
+    values = None
+    # The LLVM types of builtin types, by name
+    types = None
+
+# The state of the current emission. Being a context variable, every thread
+# and task has its own, so that emissions may run concurrently
+_current = ContextVar("llvm.State", default=None)
+
+def stateProperty(name:str):
+    return classproperty(lambda cls: getattr(_current.get(), name, None))
+
+# An attribute of objects holding an LLVM value of the current emission. Values
+# are kept by the emission rather than the objects, as objects are emitted into
+# more than one module when they are reused, such as the builtins and the
+# definitions kept by lekvar.reverify
+def emissionProperty(name:str):
+    def get(self):
+        state = _current.get()
+        return state.values.get((self, name)) if state is not None else None
+
+    def set(self, value):
+        State.current.values[(self, name)] = value
+
+    return property(get, set)
+
+# The interface to the state of the current emission
 class State:
+    logger = stateProperty("logger")
+    self = stateProperty("self")
+    context = stateProperty("context")
+    builder = stateProperty("builder")
+    module = stateProperty("module")
+    main = stateProperty("main")
+
+    @classproperty
+    def current(cls) -> EmitterState:
+        return _current.get()
+
+    # Emit within a new state, restoring the previous state afterwards
     @classmethod
     @contextmanager
     def begin(cls, name:str, logger:logging.Logger):
-        cls.logger = logger
-
-        cls.self = None
-        cls.builder = llvm.Builder.new()
-        cls.module = llvm.Module.fromName(name)
-
-        main_type = llvm.Function.new(llvm.Int.new(32), [], False)
-        cls.main = cls.module.addFunction("main", main_type)
-        cls.main.appendBlock("entry")
-        main_exit = cls.main.appendBlock("exit")
-
-        yield
-
-        # add a goto exit for the last block
-        with cls.blockScope(cls.main.getLastBlock().getPrevious()):
-            State.builder.br(main_exit)
-
-        with cls.blockScope(main_exit):
-            return_value = llvm.Value.constInt(llvm.Int.new(32), 0, False)
-            cls.builder.ret(return_value)
+        state = EmitterState()
+        state.logger = logger
+        state.values = {}
+
+        state.context = llvm.Context.new()
+        state.builder = llvm.Builder.withContext(state.context)
+        state.module = llvm.Module.fromNameWithContext(name, state.context)
+        state.types = builtinTypes(state.context)
+
+        main_type = llvm.Function.new(state.context.intType(32), [], False)
+        state.main = state.module.addFunction("main", main_type)
+        state.context.appendBlock(state.main, "entry")
+        main_exit = state.context.appendBlock(state.main, "exit")
+
+        token = _current.set(state)
+        logger_token = llvm.logger.set(logger.getChild("bindings"))
+        try:
+            yield state
+
+            # add a goto exit for the last block
+            with cls.blockScope(cls.main.getLastBlock().getPrevious()):
+                State.builder.br(main_exit)
+
+            with cls.blockScope(main_exit):
+                return_value = llvm.Value.constInt(state.context.intType(32), 0, False)
+                cls.builder.ret(return_value)
+
+            state.module.verify()
+        finally:
+            llvm.logger.reset(logger_token)
+            _current.reset(token)
 
     @classmethod
     def addMainInstructions(cls, instructions:[lekvar.Object]):
@@ -69,9 +130,9 @@ class State:
     @contextmanager
     def selfScope(cls, self:llvm.Value):
         previous_self = cls.self
-        cls.self = self
+        cls.current.self = self
         yield
-        cls.self = previous_self
+        cls.current.self = previous_self
 
     @classmethod
     def getTempName(self):
@@ -91,8 +152,9 @@ class State:
 
 # Abstract extensions
 
-lekvar.BoundObject.llvm_value = None
-lekvar.Function.llvm_return = None
+lekvar.BoundObject.llvm_value = emissionProperty("llvm_value")
+lekvar.BoundObject.inline_generator = None
+lekvar.Function.llvm_return = emissionProperty("llvm_return")
 
 # Extension abstract methods apparently don't work
 #@abstract
@@ -129,6 +191,17 @@ def blank_emitValue(self):
     return None
 lekvar.Comment.emitValue = blank_emitValue
 
+# For values that aren't stored in variables. They are stored in a temporary
+# variable when their address is needed
+def temporary_emitAssignment(self):
+    value = self.emitValue()
+    variable = State.alloca(self.resolveType().emitType(), State.getTempName())
+    State.builder.store(value, variable)
+    return variable
+lekvar.Literal.emitAssignment = temporary_emitAssignment
+lekvar.Call.emitAssignment = temporary_emitAssignment
+lekvar.Attribute.emitAssignment = temporary_emitAssignment
+
 #
 # class Reference
 #
@@ -157,7 +230,12 @@ def Attribute_emitValue(self):
     if self.attribute.static:
         return self.attribute.emitValue()
 
-    self.attribute.bound_context.scope.emit()
+    scope = self.attribute.bound_context.scope
+    scope.emit()
+
+    # The value of an unboxed instance is the value of its attribute
+    if isinstance(scope, lekvar.Class) and scope.isUnboxed():
+        return self.value.emitValue()
     return self.attribute.emitValue(self.value.emitAssignment())
 lekvar.Attribute.emitValue = Attribute_emitValue
 
@@ -175,19 +253,22 @@ lekvar.Attribute.emitContext = Attribute_emitContext
 
 def Literal_emitValue(self):
     self.type.emitType()
+    type = self.type.resolveValue()
 
     if isinstance(self.data, str):
         data = State.builder.globalString(self.data, State.getTempName())
     elif isinstance(self.data, bool):
-        data = llvm.Value.constInt(llvm.Int.new(1), self.data, False)
+        data = llvm.Value.constInt(State.context.intType(1), self.data, False)
     elif isinstance(self.data, int):
-        data = llvm.Value.constInt(llvm.Int.new(64), self.data, False)
+        data = llvm.Value.constInt(State.context.intType(64), self.data, False)
     elif isinstance(self.data, float):
-        data = llvm.Value.constFloat(llvm.Float.double(), self.data)
+        data = llvm.Value.constFloat(State.context.doubleType(), self.data)
     else:
         raise InternalError("Not Implemented")
 
-    return llvm.Value.globalStruct([data], False)
+    if isinstance(type, lekvar.Class) and type.isUnboxed():
+        return data
+    return State.context.constStruct([data], False)
 
 lekvar.Literal.emitValue = Literal_emitValue
 
@@ -218,7 +299,7 @@ def Variable_emitValue(self, value=None):
     if self.llvm_context_index >= 0:
         if value is None:
             value = State.builder.structGEP(State.self, 0, State.getTempName())
-        return State.builder.load(State.builder.structGEP(value, self.llvm_context_index, State.getTempName()), State.getTempName())
+        return State.builder.load(self.emitAttribute(value), State.getTempName())
     elif self.llvm_value is not None:
         return State.builder.load(self.llvm_value, State.getTempName())
     else:
@@ -233,9 +314,17 @@ def Variable_emitAssignment(self):
 
     #context = State.builder.load(State.self, State.getTempName())
     self_value = State.builder.structGEP(State.self, 0, State.getTempName())
-    return State.builder.structGEP(self_value, self.llvm_context_index, State.getTempName())
+    return self.emitAttribute(self_value)
 lekvar.Variable.emitAssignment = Variable_emitAssignment
 
+# Returns the address of an attribute, given the address of an instance
+def Variable_emitAttribute(self, instance:llvm.Value):
+    # Unboxed instances are their only attribute
+    if self.bound_context.scope.isUnboxed():
+        return instance
+    return State.builder.structGEP(instance, self.llvm_context_index, State.getTempName())
+lekvar.Variable.emitAttribute = Variable_emitAttribute
+
 #
 # class Assignment
 #
@@ -257,8 +346,10 @@ def Module_emit(self):
 
     State.addMainInstructions(self.main)
 
+    # Unverified children are unreachable from the main instructions
     for child in self.context:
-        child.emit()
+        if getattr(child, "verified", True):
+            child.emit()
 lekvar.Module.emit = Module_emit
 
 def Module_emitValue(self):
@@ -270,6 +361,17 @@ lekvar.Module.emitValue = Module_emitValue
 #
 
 def Call_emitValue(self):
+    # Folded calls are emitted as their result, inlined calls as the
+    # expression they are replaced with
+    if self.constant is not None:
+        return self.constant.emitValue()
+    elif self.inlined is not None:
+        return self.inlined.emitValue()
+
+    # Builtin instructions are emitted in place
+    if self.function.inline_generator is not None:
+        return self.function.inline_generator([val.emitValue() for val in self.values])
+
     called = self.function.emitValue()
     # Only use the function's context if it is static
     if self.called.resolveValue().static:
@@ -314,7 +416,7 @@ lekvar.Return.emitValue = Return_emitValue
 # class Context
 #
 
-lekvar.Context.llvm_type = None
+lekvar.Context.llvm_type = emissionProperty("llvm_type")
 
 def Context_emitType(self):
     if self.llvm_type is not None: return self.llvm_type
@@ -325,9 +427,9 @@ def Context_emitType(self):
         types.append(child.resolveType().emitType())
 
     if len(types) > 0:
-        self.llvm_type = llvm.Struct.new(types, False)
+        self.llvm_type = State.context.structType(types, False)
     else:
-        self.llvm_type = llvm.Pointer.void_p()
+        self.llvm_type = llvm.Pointer.new(State.context.intType(8), 0)
 
     return self.llvm_type
 lekvar.Context.emitType = Context_emitType
@@ -336,7 +438,7 @@ lekvar.Context.emitType = Context_emitType
 # class DependentType
 #
 
-lekvar.DependentType.llvm_type = None
+lekvar.DependentType.llvm_type = emissionProperty("llvm_type")
 
 def DependentType_emitType(self):
     if self.llvm_type is None:
@@ -351,8 +453,8 @@ lekvar.DependentType.emitType = DependentType_emitType
 # class Function
 #
 
-lekvar.Function.llvm_closure_type = None
-lekvar.Function.llvm_context = None
+lekvar.Function.llvm_closure_type = emissionProperty("llvm_closure_type")
+lekvar.Function.llvm_context = emissionProperty("llvm_context")
 
 def Function_emit(self):
     if self.dependent: return
@@ -364,8 +466,8 @@ def Function_emit(self):
     func_type = self.resolveType().emitType(self.llvm_closure_type)
     self.llvm_value = State.module.addFunction(name, func_type)
 
-    entry = self.llvm_value.appendBlock("entry")
-    exit = self.llvm_value.appendBlock("exit")
+    entry = State.context.appendBlock(self.llvm_value, "entry")
+    exit = State.context.appendBlock(self.llvm_value, "exit")
 
     with State.blockScope(entry):
 
@@ -457,6 +559,26 @@ def Constructor_emitContext(self, self_value = None):
     return llvm.Value.null(self.llvm_closure_type)
 lekvar.Constructor.emitContext = Constructor_emitContext
 
+# Constructors of unboxed classes which only assign their argument to the
+# attribute construct the argument itself, so calls of them are emitted in place
+def Constructor_inline_generator(self):
+    cls = self.bound_context.scope.bound_context.scope
+    if not cls.isUnboxed() or len(self.arguments) != 1:
+        return None
+
+    instructions = [instruction for instruction in self.instructions
+                    if not isinstance(instruction, lekvar.Comment)]
+    if len(instructions) != 1 or not isinstance(instructions[0], lekvar.Assignment):
+        return None
+
+    assignment = instructions[0]
+    if assignment.variable.bound_context is None or assignment.variable.bound_context.scope is not cls:
+        return None
+    if not isinstance(assignment.value, lekvar.Reference) or assignment.value.value is not self.arguments[0]:
+        return None
+    return lambda arguments: arguments[0]
+lekvar.Constructor.inline_generator = property(Constructor_inline_generator)
+
 #
 # class FunctionType
 #
@@ -472,7 +594,7 @@ def FunctionType_emitType(self, context_type = None):
     if self.return_type is not None:
         return_type = self.return_type.emitType()
     else:
-        return_type = llvm.Type.void()
+        return_type = State.context.voidType()
     return llvm.Function.new(return_type, arguments, False)
 lekvar.FunctionType.emitType = FunctionType_emitType
 
@@ -480,7 +602,7 @@ lekvar.FunctionType.emitType = FunctionType_emitType
 # class ExternalFunction
 #
 
-lekvar.ExternalFunction.llvm_closure_type = None
+lekvar.ExternalFunction.llvm_closure_type = emissionProperty("llvm_closure_type")
 
 def ExternalFunction_emit(self):
     if self.llvm_value is not None: return
@@ -499,15 +621,21 @@ lekvar.ExternalFunction.emitValue = ExternalFunction_emitValue
 #
 
 def Method_emit(self):
+    # Unverified overloads are lazy builtins which were never used
     for overload in self.overload_context:
-        overload.emit()
+        if overload.verified:
+            overload.emit()
 lekvar.Method.emit = Method_emit
 
 #
 # class Class
 #
 
-lekvar.Class.llvm_type = None
+lekvar.Class.llvm_type = emissionProperty("llvm_type")
+# Instances of classes with a single attribute of a scalar builtin type, such as
+# Int, Real and Bool, are unboxed: represented by the value of that attribute
+lekvar.Class.llvm_unboxed = None
+lekvar.BoundObject.llvm_scalar = False
 
 def Class_emit(self):
     self.constructor.emit()
@@ -516,6 +644,13 @@ def Class_emit(self):
 
 lekvar.Class.emit = Class_emit
 
+def Class_isUnboxed(self):
+    if self.llvm_unboxed is None:
+        variables = [child for child in self.instance_context if isinstance(child, lekvar.Variable)]
+        self.llvm_unboxed = len(variables) == 1 and variables[0].type.resolveValue().llvm_scalar
+    return self.llvm_unboxed
+lekvar.Class.isUnboxed = Class_isUnboxed
+
 def Class_emitType(self):
     if self.llvm_type is None:
         var_types = []
@@ -525,7 +660,10 @@ def Class_emitType(self):
                 child.llvm_context_index = len(var_types)
                 var_types.append(child.type.emitType())
 
-        self.llvm_type = llvm.Struct.new(var_types, False)
+        if self.isUnboxed():
+            self.llvm_type = var_types[0]
+        else:
+            self.llvm_type = State.context.structType(var_types, False)
 
     return self.llvm_type
 lekvar.Class.emitType = Class_emitType
@@ -540,8 +678,8 @@ def Loop_emitValue(self):
     # Grab the last block
     last_block = self.function.llvm_value.getLastBlock()
     # Create blocks
-    loop_block = last_block.insertBlock("loop")
-    self.after = last_block.insertBlock("after")
+    loop_block = State.context.insertBlock(last_block, "loop")
+    self.after = State.context.insertBlock(last_block, "after")
 
     # Reposition builder
     State.builder.br(loop_block)
@@ -575,12 +713,15 @@ def Branch_emitValue(self):
     # Grab the last block
     last_block = self.function.llvm_value.getLastBlock()
     # Create blocks
-    if_block = last_block.insertBlock("if")
-    else_block = last_block.insertBlock("else")
-    after = last_block.insertBlock("after")
-
-    # Emit condition
-    condition = State.builder.extractValue(self.condition.emitValue(), 0, State.getTempName())
+    if_block = State.context.insertBlock(last_block, "if")
+    else_block = State.context.insertBlock(last_block, "else")
+    after = State.context.insertBlock(last_block, "after")
+
+    # Emit condition, which is only in a structure if it isn't unboxed
+    condition = self.condition.emitValue()
+    condition_type = self.condition.resolveType().resolveValue()
+    if not (isinstance(condition_type, lekvar.Class) and condition_type.isUnboxed()):
+        condition = State.builder.extractValue(condition, 0, State.getTempName())
     State.builder.condBr(condition, if_block, else_block)
 
     for block, instructions in [(if_block, self.true_instructions), (else_block, self.false_instructions)]:
@@ -603,36 +744,35 @@ from . import builtins
 # class LLVMType
 #
 
-LLVM_MAP = None
+builtins.LLVMType.llvm_scalar = True
 
 def LLVMType_emit(self):
     pass
 builtins.LLVMType.emit = LLVMType_emit
 
+# The LLVM types of builtin types within an LLVM context
+def builtinTypes(context:llvm.Context):
+    return {
+        "String": llvm.Pointer.new(context.intType(8), 0),
+        "Bool": context.intType(1),
+        "Int8": context.intType(8),
+        "Int16": context.intType(16),
+        "Int32": context.intType(32),
+        "Int64": context.intType(64),
+        "Int128": context.intType(128),
+        "Float16": context.halfType(),
+        "Float32": context.floatType(),
+        "Float64": context.doubleType(),
+    }
+
 def LLVMType_emitType(self):
-    global LLVM_MAP
-    if LLVM_MAP is None:
-        LLVM_MAP = {
-            "String": llvm.Pointer.new(llvm.Int.new(8), 0),
-            "Bool": llvm.Int.new(1),
-            "Int8": llvm.Int.new(8),
-            "Int16": llvm.Int.new(16),
-            "Int32": llvm.Int.new(32),
-            "Int64": llvm.Int.new(64),
-            "Int128": llvm.Int.new(128),
-            "Float16": llvm.Float.half(),
-            "Float32": llvm.Float.float(),
-            "Float64": llvm.Float.double(),
-        }
-    return LLVM_MAP[self.name]
+    return State.current.types[self.name]
 builtins.LLVMType.emitType = LLVMType_emitType
 
 #
 # class LLVMFunction
 #
 
-builtins.LLVMFunction.llvm_value = None
-
 def LLVMFunction_emit(self):
     if self.llvm_value is None:
         self.generator(self)
@@ -1,9 +1,12 @@
 import os
+from pickle import dumps, loads
 from subprocess import check_output
 
+from .. import lekvar
 from .bindings import *
-from .builtins import builtins
+# The emitter must be imported before the builtins it extends
 from .emitter import emit
+from .builtins import builtins, LLVMType
 
 BUILD_PATH = "build/tests"
 
@@ -33,9 +36,25 @@ def test_llvm():
     assert b"Hello World!\n" == check_output(["lli " + BUILD_PATH + "/llvm.ll"], shell=True)
 
 def test_builtin_lib():
-    source = emit(builtins())
+    module = builtins()
+    # Only verified objects are emitted
+    lekvar.verify(module, module)
+    source = emit(module)
+
+    functions = [overload for child in module.context if isinstance(child, lekvar.Method)
+                 for overload in child.overload_context]
+    assert len(functions) > 0
+    # All functions are defined, along with main
+    assert source.count(b"define ") == len(functions) + 1
 
     os.makedirs(BUILD_PATH, exist_ok=True)
     with open(BUILD_PATH + "/builtins.ll", "wb") as f:
         f.write(source)
 
+def test_llvm_types():
+    # Types of separate builtins are separate, but compatible
+    first, second = LLVMType("Int64"), loads(dumps(LLVMType("Int64")))
+    assert first is not second
+    assert first.checkCompatibility(second)
+    assert first.resolveDispatchKey() == second.resolveDispatchKey()
+    assert not first.checkCompatibility(LLVMType("Int32"))
@@ -7,6 +7,7 @@ import argparse
 import cProfile
 from io import StringIO
 
+from compiler import VERSION
 from compiler.errors import CompilerError
 from compiler.jam import compiler
 
@@ -39,7 +40,17 @@ parser.add_argument("--norun", "-r",
 parser.add_argument("--version",
     help="Prints the version of the program.",
     action='version',
-    version="Jam Compiler V0.1a",
+    version="Jam Compiler V{}".format(VERSION),
+)
+parser.add_argument("--no-cache",
+    help="Don't use or update the cache of parsed source files.",
+    action='store_true',
+    required=False,
+)
+parser.add_argument("--library",
+    help="Compile all definitions, even those the program never uses.",
+    action='store_true',
+    required=False,
 )
 parser.add_argument("--profile",
     help="Uses cProfile to profile the compiler.",
@@ -62,7 +73,7 @@ def main():
 
     with args.input, output:
         try:
-            print(compile(args.input, output), end="")
+            print(compile(args.input, output, cache=not args.no_cache, library=args.library), end="")
         except CompilerError as e:
             message = e.args[0]
             print("{}: {}".format(type(e).__name__, message))